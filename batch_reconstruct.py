@@ -0,0 +1,186 @@
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+
+# Only the reconstruction side of the package is imported, so this runs on machines without PyQt6 or matplotlib
+from utils.file_manager import FileManager
+from utils.reconstruction.reconstruct_3d import process_2d_data_to_3d, threshold_by_confidence, ReprojectionErrorFilterSettings
+from utils.reconstruction.reconstruction_store import ReconstructionStore
+
+logger = logging.getLogger(__name__)
+
+SPATIAL_DATA_FILE_NAME = 'mediapipe3dData_numFrames_numTrackedPoints_spatialXYZ.npy'
+REPROJECTION_ERROR_FILE_NAME = 'mediapipe3dData_numFrames_numTrackedPoints_reprojectionError.npy'
+RECONSTRUCTION_STORE_FOLDER_NAME = 'reconstruction_store'
+
+
+def get_output_paths(recording_session_folder_path, use_chunked_store=False):
+    output_data_folder_path = FileManager(recording_session_folder_path).get_output_data_folder_path()
+    if use_chunked_store:
+        # The edit log is the last thing written to the store, so a store from an interrupted run doesn't count
+        return [output_data_folder_path / RECONSTRUCTION_STORE_FOLDER_NAME / ReconstructionStore.edit_log_file_name]
+    return [output_data_folder_path / SPATIAL_DATA_FILE_NAME, output_data_folder_path / REPROJECTION_ERROR_FILE_NAME]
+
+
+def reconstruct_session(recording_session_folder_path, calibration_toml_path, mediapipe_confidence_cutoff_threshold, reprojection_error_filter_settings, overwrite=False, use_chunked_store=False, number_of_processes=1, frames_per_chunk=None):
+    # Runs in a worker process, returns the number of frames reconstructed and how long it took (or None if the session was skipped).
+    # With number_of_processes over 1 the session's frames are split into chunks reconstructed in that many processes of their own
+    output_paths = get_output_paths(recording_session_folder_path, use_chunked_store)
+    if not overwrite and all(path.exists() for path in output_paths):
+        return None
+
+    start_time = time.perf_counter()
+    file_manager = FileManager(recording_session_folder_path)
+    joint_2d_data = file_manager.get_joint_2d_data()
+    joint_2d_confidence = file_manager.get_joint_2d_confidence()
+    if joint_2d_confidence is not None:
+        joint_2d_confidence = joint_2d_confidence.astype(np.float16)
+
+    if use_chunked_store:
+        return reconstruct_session_into_store(file_manager, joint_2d_data, joint_2d_confidence, calibration_toml_path, mediapipe_confidence_cutoff_threshold, reprojection_error_filter_settings, start_time, number_of_processes, frames_per_chunk)
+
+    spatial_data3d, reprojection_error_data3d = process_2d_data_to_3d(
+        mediapipe_2d_data=np.asarray(joint_2d_data, dtype=np.float64),
+        mediapipe_confidence_data=joint_2d_confidence,
+        calibration_toml_path=calibration_toml_path,
+        mediapipe_confidence_cutoff_threshold=mediapipe_confidence_cutoff_threshold,
+        reprojection_error_filter_settings=reprojection_error_filter_settings,
+        number_of_processes=number_of_processes,
+        frames_per_chunk=frames_per_chunk,
+        show_progress=False,
+    )
+
+    # Written to a temporary file first, so an interrupted run never leaves a half written output behind
+    for path, data in zip(output_paths, [spatial_data3d, reprojection_error_data3d]):
+        temporary_path = path.with_name(path.name + '.tmp')
+        with open(temporary_path, 'wb') as file:
+            np.save(file, data)
+        os.replace(temporary_path, path)
+
+    return spatial_data3d.shape[0], time.perf_counter() - start_time
+
+
+def reconstruct_session_into_store(file_manager, joint_2d_data, joint_2d_confidence, calibration_toml_path, mediapipe_confidence_cutoff_threshold, reprojection_error_filter_settings, start_time, number_of_processes=1, frames_per_chunk=None):
+    # Each block of frames goes into the chunked store as soon as it is reconstructed, with the mask of the 2D points that went into it
+    number_of_cameras, number_of_frames, number_of_tracked_points, _ = joint_2d_data.shape
+    store = ReconstructionStore.create(
+        file_manager.get_output_data_folder_path() / RECONSTRUCTION_STORE_FOLDER_NAME,
+        number_of_cameras,
+        number_of_frames,
+        number_of_tracked_points,
+    )
+
+    def write_chunk(start_frame, end_frame, spatial_data3d, reprojection_error_data3d):
+        visibility_mask = threshold_by_confidence(
+            mediapipe_2d_data=joint_2d_data[:, start_frame:end_frame],
+            mediapipe_confidence_data=joint_2d_confidence[:, start_frame:end_frame] if joint_2d_confidence is not None else None,
+            mediapipe_confidence_cutoff_threshold=mediapipe_confidence_cutoff_threshold,
+        )
+        store.write_frames(start_frame, spatial_data3d, reprojection_error_data3d, visibility_mask)
+
+    process_2d_data_to_3d(
+        mediapipe_2d_data=np.asarray(joint_2d_data, dtype=np.float64),
+        mediapipe_confidence_data=joint_2d_confidence,
+        calibration_toml_path=calibration_toml_path,
+        mediapipe_confidence_cutoff_threshold=mediapipe_confidence_cutoff_threshold,
+        reprojection_error_filter_settings=reprojection_error_filter_settings,
+        chunk_callback=write_chunk,
+        number_of_processes=number_of_processes,
+        frames_per_chunk=frames_per_chunk,
+        show_progress=False,
+    )
+    # Batch runs start from the unedited 2D data
+    store.save_edit_log({})
+    return number_of_frames, time.perf_counter() - start_time
+
+
+def reconstruct_sessions(recording_session_folder_paths, calibration_toml_path, mediapipe_confidence_cutoff_threshold=.5, reprojection_error_filter_settings=None, number_of_workers=None, overwrite=False, use_chunked_store=False, number_of_processes_per_session=1, frames_per_chunk=None):
+    # Each session is reconstructed whole in one worker, returns the sessions that failed
+    failed_session_folder_paths = []
+    with ProcessPoolExecutor(max_workers=number_of_workers) as executor:
+        futures = {
+            executor.submit(
+                reconstruct_session,
+                recording_session_folder_path,
+                calibration_toml_path,
+                mediapipe_confidence_cutoff_threshold,
+                reprojection_error_filter_settings,
+                overwrite,
+                use_chunked_store,
+                number_of_processes_per_session,
+                frames_per_chunk,
+            ): recording_session_folder_path
+            for recording_session_folder_path in recording_session_folder_paths
+        }
+
+        for future in as_completed(futures):
+            recording_session_folder_path = futures[future]
+            try:
+                result = future.result()
+            except Exception:
+                logger.exception("Failed to reconstruct %s", recording_session_folder_path)
+                failed_session_folder_paths.append(recording_session_folder_path)
+                continue
+
+            if result is None:
+                logger.info("Skipped %s, its 3D data already exists", recording_session_folder_path)
+            else:
+                number_of_frames, duration = result
+                logger.info("Reconstructed %d frames of %s in %.1f s", number_of_frames, recording_session_folder_path, duration)
+
+    return failed_session_folder_paths
+
+
+def parse_arguments(arguments=None):
+    parser = argparse.ArgumentParser(description='Reconstruct the 3D data of recording sessions without opening the viewer')
+    parser.add_argument('recording_session_folder_paths', nargs='+', type=Path, help='recording session folders, each with its output_data/raw_data 2D data')
+    parser.add_argument('--calibration', type=Path, required=True, help='camera calibration TOML shared by the sessions')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of sessions reconstructed at the same time')
+    parser.add_argument('--confidence-threshold', type=float, default=.5, help='points with a MediaPipe confidence at or under this are left out')
+    parser.add_argument('--reprojection-error-threshold', type=float, default=None, help='in pixels, on the mean error across cameras')
+    parser.add_argument('--per-joint-percentile', type=float, default=None, help='e.g. 95 drops the worst 5%% of each joint\'s frames')
+    parser.add_argument('--per-camera-reprojection-error-threshold', type=float, default=None, help='in pixels, on each camera\'s error')
+    parser.add_argument('--filter-passes', type=int, default=1, help='how many times a failing point can have its worst camera dropped, 0 drops failing points without a retry')
+    parser.add_argument('--overwrite', action='store_true', help='reconstruct sessions that already have 3D data')
+    parser.add_argument('--processes-per-session', type=int, default=1, help='split each session\'s frames into chunks reconstructed in this many processes, for a few long sessions (keep workers x processes within the number of cores)')
+    parser.add_argument('--frames-per-chunk', type=int, default=None, help='frames in each chunk with --processes-per-session, by default four chunks per process')
+    parser.add_argument('--chunked-store', action='store_true', help='write a chunked, compressed reconstruction store instead of .npy files')
+    return parser.parse_args(arguments)
+
+
+def main(arguments=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    arguments = parse_arguments(arguments)
+
+    reprojection_error_filter_settings = ReprojectionErrorFilterSettings(
+        reprojection_error_threshold=arguments.reprojection_error_threshold,
+        per_joint_percentile=arguments.per_joint_percentile,
+        per_camera_reprojection_error_threshold=arguments.per_camera_reprojection_error_threshold,
+        number_of_passes=arguments.filter_passes,
+    )
+
+    failed_session_folder_paths = reconstruct_sessions(
+        arguments.recording_session_folder_paths,
+        arguments.calibration,
+        mediapipe_confidence_cutoff_threshold=arguments.confidence_threshold,
+        reprojection_error_filter_settings=reprojection_error_filter_settings,
+        number_of_workers=arguments.workers,
+        overwrite=arguments.overwrite,
+        use_chunked_store=arguments.chunked_store,
+        number_of_processes_per_session=arguments.processes_per_session,
+        frames_per_chunk=arguments.frames_per_chunk,
+    )
+
+    if failed_session_folder_paths:
+        logger.error("%d of %d sessions failed", len(failed_session_folder_paths), len(arguments.recording_session_folder_paths))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,7 +2,7 @@ import cv2
 from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg
 from matplotlib.figure import Figure
 from PyQt6.QtWidgets import QApplication, QMainWindow, QTabWidget, QVBoxLayout, QHBoxLayout, QSlider, QWidget, QCheckBox, QPushButton, QGroupBox, QLabel, QLineEdit
-from PyQt6.QtCore import Qt
+from PyQt6.QtCore import Qt, QTimer
 from pathlib import Path
 
 import numpy as np
@@ -11,29 +11,20 @@ from typing import Union
 
 from widgets.video_tab import VideoTab
 from widgets.main_window_tab import MainTab
+from widgets.proxy_video_thread import ProxyVideoThread
+from widgets.frame_index_thread import FrameIndexThread
+from widgets.playback_controller import PlaybackController
+from widgets.camera_grid_tab import CameraGridTab
+from widgets.lazy_tab import LazyTab
+from utils.video_loader import VideoLoaderRegistry
+from utils.file_manager import FileManager
 from utils.joint_data_holder import JointDataHolder
 from utils.reconstructed_data_holder import ReconstructedDataHolder
 import os
+import time
 
-class FileManager:
-    def __init__(self, recording_session_folder_path: Union[str,Path]):
-        self.recording_session_folder_path = recording_session_folder_path
-        
-        self.video_folder_path = recording_session_folder_path/'synchronized_videos'
-        self.joint_2d_data_path = recording_session_folder_path/ 'output_data' / 'raw_data' / 'mediapipe2dData_numCams_numFrames_numTrackedPoints_pixelXY.npy'
-        f = 2
-
-    def get_video_folder_path(self):
-        return self.video_folder_path
-    
-    def get_joint_2d_data(self):
-
-        joint_2d_data_all = np.load(self.joint_2d_data_path)
-        joint_2d_data_xy = joint_2d_data_all[:,:,:,0:2]
-        return joint_2d_data_xy
-    
 class MainWindow(QMainWindow):
-    def __init__(self, recording_session_folder_path: Union[str,Path], calibration_toml_path: Union[str,Path]):
+    def __init__(self, recording_session_folder_path: Union[str,Path], calibration_toml_path: Union[str,Path], use_proxy_videos: bool = True):
         super().__init__()
         self.setWindowTitle('Video Viewer')
         self.tab_widget = QTabWidget()
@@ -41,10 +32,11 @@ class MainWindow(QMainWindow):
         self.file_manager = FileManager(recording_session_folder_path)
 
         joint_2d_data = self.file_manager.get_joint_2d_data()
+        joint_2d_confidence = self.file_manager.get_joint_2d_confidence()
         video_folder_path = self.file_manager.get_video_folder_path()
 
 
-        self.joint_data_loader = JointDataHolder(joint_2d_data)
+        self.joint_data_loader = JointDataHolder(joint_2d_data, joint_2d_confidence)
         self.reconstructed_data_holder = ReconstructedDataHolder(calibration_toml_path,self.joint_data_loader)
 
         # self.reconstructed_data_holder.reconstruct_new_3d_data()
@@ -52,15 +44,154 @@ class MainWindow(QMainWindow):
         save_tab = MainTab(self.joint_data_loader, self.reconstructed_data_holder)
         self.tab_widget.addTab(save_tab, "Save")
     
-        # Load each video in the video folder into a new tab
-        for i, video_path in enumerate(video_folder_path.iterdir()):
-            if video_path.suffix in ['.mp4', '.avi']:  # add more video formats if needed
-                video_tab = VideoTab(video_path, self.joint_data_loader, i)
-                self.tab_widget.addTab(video_tab, video_path.name)
+        # Only the videos are numbered, so other files in the folder (like the frame indexes) don't shift the camera numbers
+        self.video_paths = sorted(video_path for video_path in video_folder_path.iterdir() if video_path.suffix in ['.mp4', '.avi'])  # add more video formats if needed
+
+        # Every camera tab follows one shared frame index, which the playback controls play back in real time.
+        # It starts out with the 2D data's frame count, the videos' frame counts and frame rate are read from their frame indexes
+        # in the background, since building an index the first time a video is opened means reading through all of it
+        self.playback_controller = PlaybackController(self.joint_data_loader.get_number_of_frames(), parent=self)
+        self.frame_index_thread = FrameIndexThread(self.video_paths)
+        self.frame_index_thread.frame_indexes_ready.connect(self.set_frame_indexes)
+        self.frame_index_thread.start()
+
+        # Each video gets one loader, shared by its camera tab and the grid
+        self.video_loader_registry = VideoLoaderRegistry()
+
+        # The camera tabs (and their decoders) are only built the first time they're shown, which keeps startup fast
+        self.video_tabs = []
+        self.lazy_tabs = []
+        for i, video_path in enumerate(self.video_paths):
+            lazy_tab = LazyTab(lambda video_path=video_path, i=i: self.create_video_tab(video_path, i))
+            self.tab_widget.addTab(lazy_tab, video_path.name)
+            self.lazy_tabs.append(lazy_tab)
+
+        # A tab with every camera side by side, following the same frame index
+        self.camera_grid_tab = None
+        lazy_tab = LazyTab(self.create_camera_grid_tab)
+        self.tab_widget.addTab(lazy_tab, "All Cameras")
+        self.lazy_tabs.append(lazy_tab)
+
+        # Decoders of tabs that haven't been looked at for a while are closed, they reopen when the tab is shown again
+        self.decoder_idle_timeout = 60  # seconds
+        self.tab_widget.currentChanged.connect(self.on_tab_changed)
+        self.previous_tab = self.tab_widget.currentWidget()
+        self.idle_decoder_timer = QTimer(self)
+        self.idle_decoder_timer.timeout.connect(self.release_idle_decoders)
+        self.idle_decoder_timer.start(10 * 1000)
+
+        # Low resolution proxies for scrubbing are made in the background, the tabs use the full videos until they're ready
+        self.proxy_paths = {}
+        self.proxy_video_thread = None
+        if use_proxy_videos:
+            self.proxy_video_thread = ProxyVideoThread(self.video_paths)
+            self.proxy_video_thread.proxy_videos_ready.connect(self.set_proxy_videos)
+            self.proxy_video_thread.start()
+
+        self.playback_layout = QHBoxLayout()
+
+        self.play_button = QPushButton("Play")
+        self.play_button.clicked.connect(self.playback_controller.toggle_playback)
+        self.playback_controller.playback_state_changed.connect(self.update_play_button)
+        self.playback_layout.addWidget(self.play_button)
+
+        self.playback_stats_label = QLabel("")
+        self.playback_layout.addWidget(self.playback_stats_label)
+
+        # The counters are shown a couple of times a second rather than every frame, so the label doesn't slow playback down
+        self.playback_stats_timer = QTimer(self)
+        self.playback_stats_timer.timeout.connect(self.update_playback_stats)
 
         # self.setStyleSheet("background-color: #F6F9F8;")  # Set background color to white
 
-        self.setCentralWidget(self.tab_widget)
+        central_widget = QWidget()
+        central_layout = QVBoxLayout()
+        central_widget.setLayout(central_layout)
+        central_layout.addWidget(self.tab_widget)
+        central_layout.addLayout(self.playback_layout)
+        self.setCentralWidget(central_widget)
+
+    def update_play_button(self, playing):
+        self.play_button.setText("Pause" if playing else "Play")
+        if playing:
+            self.playback_stats_timer.start(500)
+        else:
+            self.playback_stats_timer.stop()
+            self.update_playback_stats()
+
+    def update_playback_stats(self):
+        playback_controller = self.playback_controller
+        self.playback_stats_label.setText(
+            f"Frame {playback_controller.current_frame} | Dropped frames: {playback_controller.dropped_frames} | "
+            f"Latency: {playback_controller.last_latency * 1000:.1f} ms (mean {playback_controller.get_mean_latency() * 1000:.1f} ms)"
+        )
+
+    def create_video_tab(self, video_path, camera_num):
+        video_tab = VideoTab(video_path, self.joint_data_loader, camera_num, self.video_loader_registry)
+        video_tab.set_shared_frame(self.playback_controller.current_frame)
+        if video_path in self.proxy_paths:
+            video_tab.set_proxy_video(self.proxy_paths[video_path])
+        video_tab.slider.valueChanged.connect(self.playback_controller.set_frame)
+        self.playback_controller.frame_changed.connect(video_tab.set_shared_frame)
+        self.video_tabs.append(video_tab)
+        return video_tab
+
+    def create_camera_grid_tab(self):
+        self.camera_grid_tab = CameraGridTab(
+            self.video_paths,
+            self.joint_data_loader,
+            self.playback_controller.number_of_frames,
+            self.video_loader_registry,
+            self.proxy_paths,
+        )
+        self.camera_grid_tab.set_shared_frame(self.playback_controller.current_frame)
+        self.camera_grid_tab.slider.valueChanged.connect(self.playback_controller.set_frame)
+        self.playback_controller.frame_changed.connect(self.camera_grid_tab.set_shared_frame)
+        return self.camera_grid_tab
+
+    def on_tab_changed(self, index):
+        # The tab being left counts as active up to now
+        if isinstance(self.previous_tab, LazyTab):
+            self.previous_tab.last_active_time = time.monotonic()
+        self.previous_tab = self.tab_widget.widget(index)
+
+    def release_idle_decoders(self):
+        # The loaders are shared between tabs, so the ones the current tab is showing stay open
+        current_tab = self.tab_widget.currentWidget()
+        video_loaders_in_use = []
+        if isinstance(current_tab, LazyTab) and current_tab.widget is not None:
+            video_loaders_in_use = current_tab.widget.get_video_loaders()
+
+        now = time.monotonic()
+        for lazy_tab in self.lazy_tabs:
+            if lazy_tab.widget is None or lazy_tab is current_tab:
+                continue
+            if now - lazy_tab.last_active_time > self.decoder_idle_timeout:
+                lazy_tab.widget.release_decoders(video_loaders_in_use)
+
+    def closeEvent(self, event):
+        self.frame_index_thread.wait()
+        for lazy_tab in self.lazy_tabs:
+            if lazy_tab.widget is not None:
+                lazy_tab.widget.release_decoders()
+        self.video_loader_registry.release_all()
+        super().closeEvent(event)
+
+    def set_frame_indexes(self, frame_indexes):
+        number_of_frames = min([frame_index.number_of_frames for frame_index in frame_indexes] + [self.joint_data_loader.get_number_of_frames()])
+        fps = next((frame_index.fps for frame_index in frame_indexes if frame_index.fps > 0), 30)
+        self.playback_controller.set_timing(number_of_frames, fps)
+        if self.camera_grid_tab is not None:
+            self.camera_grid_tab.set_number_of_frames(number_of_frames)
+
+    def set_proxy_videos(self, proxy_paths):
+        self.proxy_paths = proxy_paths
+        for video_tab in self.video_tabs:
+            if video_tab.video_path in proxy_paths:
+                video_tab.set_proxy_video(proxy_paths[video_tab.video_path])
+        if self.camera_grid_tab is not None:
+            video_loaders_in_use = [video_loader for video_tab in self.video_tabs for video_loader in video_tab.get_video_loaders()]
+            self.camera_grid_tab.set_proxy_videos(proxy_paths, video_loaders_in_use)
 
 
 def main():
@@ -0,0 +1,35 @@
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+
+
+class FileManager:
+    def __init__(self, recording_session_folder_path: Union[str,Path]):
+        recording_session_folder_path = Path(recording_session_folder_path)
+        self.recording_session_folder_path = recording_session_folder_path
+        
+        self.video_folder_path = recording_session_folder_path/'synchronized_videos'
+        self.output_data_folder_path = recording_session_folder_path / 'output_data'
+        self.joint_2d_data_path = self.output_data_folder_path / 'raw_data' / 'mediapipe2dData_numCams_numFrames_numTrackedPoints_pixelXY.npy'
+        f = 2
+
+    def get_video_folder_path(self):
+        return self.video_folder_path
+
+    def get_output_data_folder_path(self):
+        return self.output_data_folder_path
+    
+    def get_joint_2d_data(self):
+        # Memory mapped, so only the frames that get read are loaded from disk
+        joint_2d_data_all = np.load(self.joint_2d_data_path, mmap_mode='r')
+        joint_2d_data_xy = joint_2d_data_all[:,:,:,0:2]
+        return joint_2d_data_xy
+
+    def get_joint_2d_confidence(self):
+        # The third channel holds MediaPipe's per point confidence, a [numCams, numFrames, numTrackedPoints] view that
+        # JointDataHolder reads as a compact float16 plane for the frames being reconstructed
+        joint_2d_data_all = np.load(self.joint_2d_data_path, mmap_mode='r')
+        if joint_2d_data_all.shape[-1] < 3:
+            return None
+        return joint_2d_data_all[:,:,:,2]
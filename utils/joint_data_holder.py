@@ -1,32 +1,266 @@
+import bisect
+import os
+
 import numpy as np
 
 class JointDataHolder:
-    def __init__(self, joint_2d_data):
+    def __init__(self, joint_2d_data, confidence_data=None):
+        # joint_2d_data is usually a read only memory map of the recording's 2D data, it is never written to.
+        # Edits are kept as (camera, joint) frame range exclusions that are applied whenever data gets read
         self.original_joint_data = joint_2d_data
-        self.joint_data = np.copy(self.original_joint_data)
-        self.plotting_joint_data = self.joint_data[:, :, :33, :]
+        self.confidence_data = confidence_data  # [numCams, numFrames, numTrackedPoints] MediaPipe confidence, or None if the data has none
+        self.number_of_plotted_joints = 33
+
+        self.excluded_frame_ranges = {}  # (camera_num, joint_num) -> sorted, non overlapping [(start_frame, end_frame), ...] that read as NaN
+        self.undo_stack = []  # (camera_num, joint_num, frame ranges before the edit, frame ranges after the edit)
+        self.redo_stack = []
+        self.dirty_joint_frame_ranges = {}  # joint_num -> (start_frame, end_frame) edited since the last reconstruction
+
+    def get_shape(self):
+        return self.original_joint_data.shape
+
+    def get_number_of_frames(self):
+        return self.original_joint_data.shape[1]
 
     def get_joints(self, camera_num, frame_num):
-        return self.plotting_joint_data[camera_num, frame_num]
+        joints = np.array(self.original_joint_data[camera_num, frame_num, :self.number_of_plotted_joints])
+        for (excluded_camera_num, joint_num), frame_ranges in list(self.excluded_frame_ranges.items()):
+            if excluded_camera_num != camera_num or joint_num >= self.number_of_plotted_joints:
+                continue
+            if is_frame_in_ranges(frame_ranges, frame_num):
+                joints[joint_num] = np.nan
+        return joints
 
-    def remove_joint(self, camera_num, joint_num):
-        # Make sure the joint number and camera number are within bounds
-        if joint_num < 0 or joint_num >= self.joint_data.shape[2]:
-            raise ValueError("Invalid joint number")
-        if camera_num < 0 or camera_num >= self.joint_data.shape[0]:
-            raise ValueError("Invalid camera number")
+    def get_joints_for_all_cameras(self, frame_num):
+        # Returns the [numCams, numPlottedJoints, XY] joint positions of every camera for the frame, read in one go
+        joints = np.array(self.original_joint_data[:, frame_num, :self.number_of_plotted_joints])
+        excluded_joints = [
+            (camera_num, joint_num)
+            for (camera_num, joint_num), frame_ranges in list(self.excluded_frame_ranges.items())
+            if joint_num < self.number_of_plotted_joints and is_frame_in_ranges(frame_ranges, frame_num)
+        ]
+        if excluded_joints:
+            camera_nums, joint_nums = np.array(excluded_joints).T
+            joints[camera_nums, joint_nums] = np.nan
+        return joints
+
+    def get_joint_data(self, start_frame=None, end_frame=None, joint_nums=None, excluded_frame_ranges=None):
+        # Reads [numCams, numFrames, numJoints, XY] from the original data for the given frames and joints, with the exclusions applied.
+        # excluded_frame_ranges can be a snapshot from get_edit_snapshot to read the data as it was then, instead of the current exclusions
+        if excluded_frame_ranges is None:
+            excluded_frame_ranges = self.excluded_frame_ranges
+        start_frame, end_frame, _ = slice(start_frame, end_frame).indices(self.get_number_of_frames())
+        if joint_nums is None:
+            joint_data = np.array(self.original_joint_data[:, start_frame:end_frame])
+        else:
+            joint_data = np.array(self.original_joint_data[:, start_frame:end_frame][:, :, np.asarray(joint_nums)])
+
+        if excluded_frame_ranges:
+            joint_data[self.get_exclusion_mask(start_frame, end_frame, joint_nums, excluded_frame_ranges)] = np.nan
+        return joint_data
 
-        # Set the joint data for the specified joint to NaN for the specified camera across all frames
-        self.plotting_joint_data[camera_num, :, joint_num,:] = np.nan
-        self.joint_data[camera_num, :, joint_num,:] = np.nan
+    def get_exclusion_mask(self, start_frame=None, end_frame=None, joint_nums=None, excluded_frame_ranges=None):
+        # Returns a [numCams, numFrames, numJoints] mask of the excluded points for the given frames and joints.
+        # Every range adds a +1 where it starts and a -1 where it ends, so a single cumulative sum over the frames fills them all in
+        number_of_cameras, _, number_of_joints, _ = self.get_shape()
+        start_frame, end_frame, _ = slice(start_frame, end_frame).indices(self.get_number_of_frames())
+        if joint_nums is None:
+            joint_positions = np.arange(number_of_joints)
+        else:
+            joint_nums = np.asarray(joint_nums)
+            joint_positions = np.full(number_of_joints, -1)
+            joint_positions[joint_nums] = np.arange(len(joint_nums))
+            number_of_joints = len(joint_nums)
+
+        # Take a snapshot, the GUI can add edits while a reconstruction thread is reading
+        if excluded_frame_ranges is None:
+            excluded_frame_ranges = self.excluded_frame_ranges
+        excluded_frame_ranges = [
+            (camera_num, joint_positions[joint_num], excluded_start, excluded_end)
+            for (camera_num, joint_num), frame_ranges in list(excluded_frame_ranges.items())
+            if joint_positions[joint_num] >= 0
+            for excluded_start, excluded_end in frame_ranges
+        ]
+        exclusion_boundaries = np.zeros((number_of_cameras, end_frame - start_frame + 1, number_of_joints), dtype=np.int8)
+        if excluded_frame_ranges:
+            camera_nums, joint_columns, excluded_starts, excluded_ends = np.array(excluded_frame_ranges).T
+            excluded_starts = np.clip(excluded_starts - start_frame, 0, end_frame - start_frame)
+            excluded_ends = np.clip(excluded_ends - start_frame, 0, end_frame - start_frame)
+            # The ranges of a joint never overlap, so each boundary is hit at most once per range
+            np.add.at(exclusion_boundaries, (camera_nums, excluded_starts, joint_columns), 1)
+            np.add.at(exclusion_boundaries, (camera_nums, excluded_ends, joint_columns), -1)
+        return np.cumsum(exclusion_boundaries[:, :-1], axis=1, dtype=np.int8) > 0
+
+    def get_confidence(self, start_frame=None, end_frame=None, joint_nums=None):
+        if self.confidence_data is None:
+            return None
+        confidence_data = self.confidence_data[:, start_frame:end_frame]
+        if joint_nums is not None:
+            confidence_data = confidence_data[:, :, joint_nums]
+        return np.asarray(confidence_data, dtype=np.float16)
+
+    def is_joint_removed(self, camera_num, joint_num):
+        return self.excluded_frame_ranges.get((camera_num, joint_num)) == [(0, self.get_number_of_frames())]
+
+    def remove_joint(self, camera_num, joint_num):
+        # Exclude the specified joint for the specified camera across all frames
+        self.exclude_frame_range(camera_num, joint_num, 0, self.get_number_of_frames())
 
     def reinstate_joint(self, camera_num, joint_num):
+        self.check_joint(camera_num, joint_num)
+
+        if (camera_num, joint_num) not in self.excluded_frame_ranges:
+            return
+
+        # Dropping the exclusions makes the joint read from the original data again
+        self.record_edit(camera_num, joint_num, [])
+
+    def exclude_frame_range(self, camera_num, joint_num, start_frame, end_frame):
+        # Excludes frames [start_frame, end_frame) of the joint for the camera, merged with any ranges it touches
+        self.check_joint(camera_num, joint_num)
+        start_frame, end_frame = max(start_frame, 0), min(end_frame, self.get_number_of_frames())
+        if start_frame >= end_frame:
+            return
+
+        frame_ranges = self.excluded_frame_ranges.get((camera_num, joint_num), [])
+        new_frame_ranges = add_frame_range(frame_ranges, start_frame, end_frame)
+        if new_frame_ranges != frame_ranges:
+            self.record_edit(camera_num, joint_num, new_frame_ranges)
+
+    def reinstate_frame_range(self, camera_num, joint_num, start_frame, end_frame):
+        # Reinstates frames [start_frame, end_frame) of the joint for the camera, splitting any range it falls inside of
+        self.check_joint(camera_num, joint_num)
+        if start_frame >= end_frame:
+            return
+
+        frame_ranges = self.excluded_frame_ranges.get((camera_num, joint_num), [])
+        new_frame_ranges = subtract_frame_range(frame_ranges, start_frame, end_frame)
+        if new_frame_ranges != frame_ranges:
+            self.record_edit(camera_num, joint_num, new_frame_ranges)
+
+    def check_joint(self, camera_num, joint_num):
         # Make sure the joint number and camera number are within bounds
-        if joint_num < 0 or joint_num >= self.joint_data.shape[2]:
+        number_of_cameras, _, number_of_joints, _ = self.get_shape()
+        if joint_num < 0 or joint_num >= number_of_joints:
             raise ValueError("Invalid joint number")
-        if camera_num < 0 or camera_num >= self.joint_data.shape[0]:
+        if camera_num < 0 or camera_num >= number_of_cameras:
             raise ValueError("Invalid camera number")
 
-        # Set the joint data for the specified joint to the original value for the specified camera across all frames
-        self.plotting_joint_data[camera_num, :, joint_num,:] = self.original_joint_data[camera_num, :, joint_num]
-        self.joint_data[camera_num, :, joint_num,:] = self.original_joint_data[camera_num, :, joint_num]
+    def record_edit(self, camera_num, joint_num, frame_ranges):
+        # A new edit can't be redone past, so it clears the redo stack
+        previous_frame_ranges = self.excluded_frame_ranges.get((camera_num, joint_num), [])
+        self.undo_stack.append((camera_num, joint_num, previous_frame_ranges, frame_ranges))
+        self.redo_stack = []
+        self.set_excluded_frame_ranges(camera_num, joint_num, previous_frame_ranges, frame_ranges)
+
+    def undo(self):
+        # Returns the (camera_num, joint_num) that was changed back, or None if there was nothing to undo
+        if not self.undo_stack:
+            return None
+        camera_num, joint_num, previous_frame_ranges, frame_ranges = self.undo_stack.pop()
+        self.redo_stack.append((camera_num, joint_num, previous_frame_ranges, frame_ranges))
+        self.set_excluded_frame_ranges(camera_num, joint_num, frame_ranges, previous_frame_ranges)
+        return camera_num, joint_num
+
+    def redo(self):
+        # Returns the (camera_num, joint_num) that was changed again, or None if there was nothing to redo
+        if not self.redo_stack:
+            return None
+        camera_num, joint_num, previous_frame_ranges, frame_ranges = self.redo_stack.pop()
+        self.undo_stack.append((camera_num, joint_num, previous_frame_ranges, frame_ranges))
+        self.set_excluded_frame_ranges(camera_num, joint_num, previous_frame_ranges, frame_ranges)
+        return camera_num, joint_num
+
+    def set_excluded_frame_ranges(self, camera_num, joint_num, previous_frame_ranges, frame_ranges):
+        if frame_ranges:
+            self.excluded_frame_ranges[(camera_num, joint_num)] = frame_ranges
+        else:
+            self.excluded_frame_ranges.pop((camera_num, joint_num), None)
+
+        # Both lists are merged and sorted, so they only differ between the first and last boundary that isn't in both
+        changed_boundaries = {boundary for frame_range in previous_frame_ranges for boundary in frame_range}
+        changed_boundaries ^= {boundary for frame_range in frame_ranges for boundary in frame_range}
+        if changed_boundaries:
+            self.mark_dirty(joint_num, min(changed_boundaries), max(changed_boundaries))
+
+    def get_edit_snapshot(self):
+        # A copy of the exclusions and the edits that led to them, which later edits don't change
+        excluded_frame_ranges = {key: list(frame_ranges) for key, frame_ranges in list(self.excluded_frame_ranges.items())}
+        return excluded_frame_ranges, list(self.undo_stack)
+
+    def save_joint_data(self, path, frames_per_chunk=1000):
+        # Streams the edited data to an .npy file a chunk of frames at a time, so the whole array is never held in memory.
+        # The confidence goes back in as the third channel, where FileManager reads it from.
+        # It is written to a temporary file first, so an interrupted save never leaves a half written file behind
+        if os.path.realpath(path) in self.get_memory_mapped_paths():
+            # The file can't be replaced while it is mapped (Windows refuses outright), and the exclusions would be
+            # baked into the data they are applied to, so undo could no longer bring the excluded points back
+            raise ValueError(f"{path} is the file the 2D data is read from, save the edited data to another folder")
+        temporary_path = f"{path}.tmp"
+        number_of_channels = 2 if self.confidence_data is None else 3
+        output = np.lib.format.open_memmap(temporary_path, mode='w+', dtype=np.float64, shape=self.get_shape()[:3] + (number_of_channels,))
+        for start_frame in range(0, self.get_number_of_frames(), frames_per_chunk):
+            end_frame = start_frame + frames_per_chunk
+            output[:, start_frame:end_frame, :, 0:2] = self.get_joint_data(start_frame, end_frame)
+            if self.confidence_data is not None:
+                output[:, start_frame:end_frame, :, 2] = self.confidence_data[:, start_frame:end_frame]
+        output.flush()
+        del output
+        os.replace(temporary_path, path)
+
+    def get_memory_mapped_paths(self):
+        # The files the original data and confidence are memory mapped from, numpy views of a memmap keep its filename
+        return {
+            os.path.realpath(data.filename)
+            for data in (self.original_joint_data, self.confidence_data)
+            if getattr(data, 'filename', None) is not None
+        }
+
+    def mark_dirty(self, joint_num, start_frame, end_frame):
+        # Grow the joint's dirty frame range to cover the new edit
+        if joint_num in self.dirty_joint_frame_ranges:
+            dirty_start, dirty_end = self.dirty_joint_frame_ranges[joint_num]
+            start_frame, end_frame = min(start_frame, dirty_start), max(end_frame, dirty_end)
+        self.dirty_joint_frame_ranges[joint_num] = (start_frame, end_frame)
+
+    def get_dirty_joint_frame_ranges(self):
+        return dict(self.dirty_joint_frame_ranges)
+
+    def clear_dirty(self, reconstructed_joint_frame_ranges=None):
+        # Only forget the ranges that were reconstructed, so edits made while a reconstruction was running stay dirty
+        if reconstructed_joint_frame_ranges is None:
+            self.dirty_joint_frame_ranges = {}
+            return
+        for joint_num, frame_range in reconstructed_joint_frame_ranges.items():
+            if self.dirty_joint_frame_ranges.get(joint_num) == frame_range:
+                del self.dirty_joint_frame_ranges[joint_num]
+
+
+def is_frame_in_ranges(frame_ranges, frame_num):
+    # The ranges are sorted, so the only one that can hold the frame is the last one starting at or before it
+    range_index = bisect.bisect_right(frame_ranges, (frame_num, np.inf)) - 1
+    return range_index >= 0 and frame_num < frame_ranges[range_index][1]
+
+
+def add_frame_range(frame_ranges, start_frame, end_frame):
+    # Returns a new sorted list of ranges with [start_frame, end_frame) added, merging any that overlap or touch it
+    first_index = bisect.bisect_left([range_end for _, range_end in frame_ranges], start_frame)
+    last_index = bisect.bisect_right([range_start for range_start, _ in frame_ranges], end_frame)
+    if first_index < last_index:
+        start_frame = min(start_frame, frame_ranges[first_index][0])
+        end_frame = max(end_frame, frame_ranges[last_index - 1][1])
+    return frame_ranges[:first_index] + [(start_frame, end_frame)] + frame_ranges[last_index:]
+
+
+def subtract_frame_range(frame_ranges, start_frame, end_frame):
+    # Returns a new sorted list of ranges with [start_frame, end_frame) taken out, keeping the parts on either side of it
+    new_frame_ranges = []
+    for range_start, range_end in frame_ranges:
+        if range_end <= start_frame or range_start >= end_frame:
+            new_frame_ranges.append((range_start, range_end))
+            continue
+        if range_start < start_frame:
+            new_frame_ranges.append((range_start, start_frame))
+        if range_end > end_frame:
+            new_frame_ranges.append((end_frame, range_end))
+    return new_frame_ranges
@@ -39,9 +39,30 @@ mediapipe_indices = ['nose',
 
 joint_groups = [
     {"name": "Face", "joints": ["nose", "left_eye_inner", "left_eye", "left_eye_outer", "right_eye_inner", "right_eye", 
-    "right_eye_outer", "left_ear", "right_ear", "mouth_left", "mouth_right"]},
-    {"name": "Right Arm", "joints": ["right_shoulder", "right_elbow", "right_wrist", "right_pinky", "right_index", "right_thumb"]},
-    {"name": "Left Arm", "joints": ["left_shoulder", "left_elbow", "left_wrist", "left_pinky", "left_index", "left_thumb"]},
-    {"name": "Right Leg", "joints": ["right_hip", "right_knee", "right_ankle", "right_heel", "right_foot_index"]},
-    {"name": "Left Leg", "joints": ["left_hip", "left_knee", "left_ankle", "left_heel", "left_foot_index"]},
+    "right_eye_outer", "left_ear", "right_ear", "mouth_left", "mouth_right"],
+    "connections": [("nose", "left_eye_inner"), ("left_eye_inner", "left_eye"), ("left_eye", "left_eye_outer"), ("left_eye_outer", "left_ear"),
+    ("nose", "right_eye_inner"), ("right_eye_inner", "right_eye"), ("right_eye", "right_eye_outer"), ("right_eye_outer", "right_ear"),
+    ("mouth_left", "mouth_right")]},
+    # The torso bones (shoulders, hips and the sides) are listed with the arms and legs they join
+    {"name": "Right Arm", "joints": ["right_shoulder", "right_elbow", "right_wrist", "right_pinky", "right_index", "right_thumb"],
+    "connections": [("right_shoulder", "left_shoulder"), ("right_shoulder", "right_elbow"), ("right_elbow", "right_wrist"), ("right_wrist", "right_pinky"),
+    ("right_wrist", "right_index"), ("right_pinky", "right_index"), ("right_wrist", "right_thumb")]},
+    {"name": "Left Arm", "joints": ["left_shoulder", "left_elbow", "left_wrist", "left_pinky", "left_index", "left_thumb"],
+    "connections": [("left_shoulder", "left_elbow"), ("left_elbow", "left_wrist"), ("left_wrist", "left_pinky"),
+    ("left_wrist", "left_index"), ("left_pinky", "left_index"), ("left_wrist", "left_thumb")]},
+    {"name": "Right Leg", "joints": ["right_hip", "right_knee", "right_ankle", "right_heel", "right_foot_index"],
+    "connections": [("right_hip", "right_shoulder"), ("right_hip", "left_hip"), ("right_hip", "right_knee"), ("right_knee", "right_ankle"),
+    ("right_ankle", "right_heel"), ("right_heel", "right_foot_index"), ("right_ankle", "right_foot_index")]},
+    {"name": "Left Leg", "joints": ["left_hip", "left_knee", "left_ankle", "left_heel", "left_foot_index"],
+    "connections": [("left_hip", "left_shoulder"), ("left_hip", "left_knee"), ("left_knee", "left_ankle"),
+    ("left_ankle", "left_heel"), ("left_heel", "left_foot_index"), ("left_ankle", "left_foot_index")]},
 ]
+
+
+def get_skeleton_connections():
+    # Returns the bones of every joint group as (joint_num, joint_num) pairs of indices into mediapipe_indices
+    return [
+        (mediapipe_indices.index(first_joint), mediapipe_indices.index(second_joint))
+        for group in joint_groups
+        for first_joint, second_joint in group["connections"]
+    ]
@@ -0,0 +1,67 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import cv2
+
+logger = logging.getLogger(__name__)
+
+
+def get_proxy_path(video_path):
+    # Proxies go in a folder next to the videos, so they aren't picked up as camera videos themselves
+    video_path = Path(video_path)
+    return video_path.parent / 'proxies' / (video_path.stem + '_proxy.avi')
+
+
+def is_proxy_up_to_date(video_path):
+    proxy_path = get_proxy_path(video_path)
+    return proxy_path.exists() and os.stat(proxy_path).st_mtime_ns >= os.stat(video_path).st_mtime_ns
+
+
+def create_proxy_video(video_path, max_height=360, jpeg_quality=80):
+    # Writes a downscaled MJPEG copy of the video. Every MJPEG frame is a keyframe, so any frame can be decoded without decoding others.
+    # Returns the proxy's path, an up to date proxy is reused rather than made again
+    proxy_path = get_proxy_path(video_path)
+    if is_proxy_up_to_date(video_path):
+        return proxy_path
+    proxy_path.parent.mkdir(parents=True, exist_ok=True)
+
+    video = cv2.VideoCapture(str(video_path))
+    width = int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = video.get(cv2.CAP_PROP_FPS) or 30
+    scale = min(1.0, max_height / height)
+    proxy_size = (max(int(round(width * scale)), 1), max(int(round(height * scale)), 1))
+
+    # Written under a temporary name, so a proxy that was cut short is never mistaken for a finished one
+    temporary_proxy_path = proxy_path.with_name(proxy_path.stem + '.tmp.avi')
+    writer = cv2.VideoWriter(str(temporary_proxy_path), cv2.VideoWriter_fourcc(*'MJPG'), fps, proxy_size)
+    writer.set(cv2.VIDEOWRITER_PROP_QUALITY, jpeg_quality)
+    try:
+        while True:
+            success, frame = video.read()
+            if not success:
+                break
+            writer.write(cv2.resize(frame, proxy_size, interpolation=cv2.INTER_AREA))
+    finally:
+        writer.release()
+        video.release()
+
+    os.replace(temporary_proxy_path, proxy_path)
+    return proxy_path
+
+
+def create_proxy_videos(video_paths, max_height=360, number_of_workers=None):
+    # Makes the proxies for every camera at once, opencv releases the GIL while decoding and encoding so threads run in parallel.
+    # Returns {video_path: proxy_path}, leaving out any video whose proxy couldn't be made
+    video_paths = list(video_paths)
+    proxy_paths = {}
+    with ThreadPoolExecutor(max_workers=number_of_workers or max(len(video_paths), 1)) as executor:
+        futures = {executor.submit(create_proxy_video, video_path, max_height): video_path for video_path in video_paths}
+        for future, video_path in futures.items():
+            try:
+                proxy_paths[video_path] = future.result()
+            except Exception as e:
+                logger.warning(f"Could not make a proxy of {video_path}: {e}")
+    return proxy_paths
@@ -1,10 +1,126 @@
-from utils.reconstruction.reconstruct_3d import process_2d_data_to_3d
+import logging
+
+import numpy as np
+
+from utils.reconstruction.reconstruct_3d import process_2d_data_to_3d, threshold_by_confidence
+from utils.reconstruction.reconstruction_store import ReconstructionStore
+from utils.reconstruction.anipose_object_loader import load_cached_anipose_calibration
+from utils.reconstruction.undistortion_cache import UndistortionCache
+
+logger = logging.getLogger(__name__)
 
 class ReconstructedDataHolder:
-    def __init__(self, calibration_toml_path,joint_data_loader):
+    def __init__(self, calibration_toml_path,joint_data_loader, undistortion_cache_size_bytes=256 * 1024**2, keep_undistortion_cache=True):
         self.calibration_toml_path = calibration_toml_path
         self.joint_data_loader = joint_data_loader
+        # With keep_undistortion_cache off the cache is cleared after every reconstruction, finished or cancelled, trading speed for memory
+        self.undistortion_cache = UndistortionCache(joint_data_loader.original_joint_data, max_bytes=undistortion_cache_size_bytes)
+        self.keep_undistortion_cache = keep_undistortion_cache
+        self.calibration = None
+
+        self.new_3d_data = None
+        self.reprojection_error = None
+        self.reconstructed_frame_range = None
+        self.reconstructed_edit_snapshot = None  # the exclusions and edits the reconstruction was made from
+        self.reconstructed_calibration = None  # the cached calibration the reconstruction was made with
     
-    def reconstruct_new_3d_data(self, start_frame=None, end_frame=None):
-        new_3d_data, repro_error = process_2d_data_to_3d(mediapipe_2d_data=self.joint_data_loader.joint_data[:,start_frame:end_frame,:,:], calibration_toml_path=self.calibration_toml_path, mediapipe_confidence_cutoff_threshold=.5)
-        self.new_3d_data = new_3d_data
\ No newline at end of file
+    def reconstruct_new_3d_data(self, start_frame=None, end_frame=None, kill_event=None, progress_callback=None):
+        # Returns False if the reconstruction was cancelled through the kill event, in which case the previous results are kept
+        try:
+            return self.reconstruct(start_frame, end_frame, kill_event=kill_event, progress_callback=progress_callback)
+        finally:
+            if not self.keep_undistortion_cache:
+                self.clear_undistortion_cache()
+
+    def clear_undistortion_cache(self):
+        self.undistortion_cache.clear()
+
+    def reconstruct(self, start_frame=None, end_frame=None, kill_event=None, progress_callback=None):
+        number_of_frames = self.joint_data_loader.get_number_of_frames()
+        frame_range = slice(start_frame, end_frame).indices(number_of_frames)[:2]
+        dirty_joint_frame_ranges = self.joint_data_loader.get_dirty_joint_frame_ranges()
+        # The 2D data is read as of this snapshot, so edits made while the reconstruction runs can't end up half in it.
+        # It's taken after the dirty ranges, so an edit made in between stays dirty and gets reconstructed next time
+        edit_snapshot = self.joint_data_loader.get_edit_snapshot()
+        excluded_frame_ranges = edit_snapshot[0]
+
+        # Keep a handle on the parsed calibration, it is only reloaded if the TOML file changes, in which case it's a new object
+        self.calibration = load_cached_anipose_calibration(self.calibration_toml_path)
+
+        # If this range was already reconstructed with this calibration, only the joints edited since then need to be triangulated again
+        if frame_range == self.reconstructed_frame_range and self.calibration is self.reconstructed_calibration:
+            if not self.reconstruct_dirty_joints(dirty_joint_frame_ranges, excluded_frame_ranges, kill_event=kill_event, progress_callback=progress_callback):
+                return False
+        else:
+            new_3d_data, repro_error = process_2d_data_to_3d(mediapipe_2d_data=self.joint_data_loader.get_joint_data(start_frame, end_frame, excluded_frame_ranges=excluded_frame_ranges), mediapipe_confidence_data=self.joint_data_loader.get_confidence(start_frame, end_frame), calibration_toml_path=self.calibration_toml_path, mediapipe_confidence_cutoff_threshold=.5, kill_event=kill_event, undistortion_cache=self.undistortion_cache, start_frame=frame_range[0], progress_callback=progress_callback)
+            if new_3d_data is None:
+                return False
+            self.new_3d_data = new_3d_data
+            self.reprojection_error = repro_error
+            self.reconstructed_frame_range = frame_range
+
+        self.reconstructed_edit_snapshot = edit_snapshot
+        self.reconstructed_calibration = self.calibration
+        self.joint_data_loader.clear_dirty(dirty_joint_frame_ranges)
+        return True
+
+    def reconstruct_dirty_joints(self, dirty_joint_frame_ranges, excluded_frame_ranges, kill_event=None, progress_callback=None):
+        first_frame, end_of_range = self.reconstructed_frame_range
+
+        # Clip each dirty range to the reconstructed frames and triangulate the joints that share a range together
+        joints_by_frame_range = {}
+        for joint_num, (dirty_start, dirty_end) in dirty_joint_frame_ranges.items():
+            start_frame, end_frame = max(dirty_start, first_frame), min(dirty_end, end_of_range)
+            if start_frame < end_frame:
+                joints_by_frame_range.setdefault((start_frame, end_frame), []).append(joint_num)
+
+        # Progress is reported across all the groups, not restarted for each one
+        number_of_points = sum((end_frame - start_frame) * len(joint_nums) for (start_frame, end_frame), joint_nums in joints_by_frame_range.items())
+        number_of_points_before_group = 0
+
+        # The groups' results are only written in once every group is done, so a cancel leaves the previous reconstruction whole
+        group_results = []
+        for (start_frame, end_frame), joint_nums in joints_by_frame_range.items():
+            joint_nums = np.array(sorted(joint_nums))
+            group_progress_callback = None
+            if progress_callback is not None:
+                group_progress_callback = lambda number_of_points_done, _, offset=number_of_points_before_group: progress_callback(offset + number_of_points_done, number_of_points)
+            new_3d_data, repro_error = process_2d_data_to_3d(mediapipe_2d_data=self.joint_data_loader.get_joint_data(start_frame, end_frame, joint_nums, excluded_frame_ranges), mediapipe_confidence_data=self.joint_data_loader.get_confidence(start_frame, end_frame, joint_nums), calibration_toml_path=self.calibration_toml_path, mediapipe_confidence_cutoff_threshold=.5, kill_event=kill_event, undistortion_cache=self.undistortion_cache, start_frame=start_frame, joint_nums=joint_nums, progress_callback=group_progress_callback)
+            if new_3d_data is None:
+                return False
+            group_results.append((slice(start_frame - first_frame, end_frame - first_frame), joint_nums, new_3d_data, repro_error))
+            number_of_points_before_group += (end_frame - start_frame) * len(joint_nums)
+
+        for frame_slice, joint_nums, new_3d_data, repro_error in group_results:
+            self.new_3d_data[frame_slice, joint_nums] = new_3d_data
+            self.reprojection_error[frame_slice, joint_nums] = repro_error
+        return True
+
+    def save_reconstruction(self, store_path):
+        # Writes the reconstructed frames, which 2D points went into them and the edits made to the 2D data to a chunked store.
+        # The mask and edit log are the ones the reconstruction was made from, edits made since then aren't in it
+        if self.joint_data_loader.get_dirty_joint_frame_ranges():
+            logger.warning(f"Saving the reconstruction to {store_path} without the 2D edits made since it was reconstructed, reconstruct again to include them")
+        excluded_frame_ranges, undo_stack = self.reconstructed_edit_snapshot
+        first_frame, end_of_range = self.reconstructed_frame_range
+        number_of_cameras, _, number_of_tracked_points, _ = self.joint_data_loader.get_shape()
+        store = ReconstructionStore.create(store_path, number_of_cameras, end_of_range - first_frame, number_of_tracked_points, start_frame=first_frame)
+
+        # Written a chunk of frames at a time, so the 2D data for the mask is never all read in at once
+        frames_per_chunk = store.spatial_data.chunk_shape[0]
+        for start_frame in range(first_frame, end_of_range, frames_per_chunk):
+            end_frame = min(start_frame + frames_per_chunk, end_of_range)
+            visibility_mask = threshold_by_confidence(
+                mediapipe_2d_data=self.joint_data_loader.get_joint_data(start_frame, end_frame, excluded_frame_ranges=excluded_frame_ranges),
+                mediapipe_confidence_data=self.joint_data_loader.get_confidence(start_frame, end_frame),
+                mediapipe_confidence_cutoff_threshold=.5,
+            )
+            store.write_frames(
+                start_frame - first_frame,
+                self.new_3d_data[start_frame - first_frame:end_frame - first_frame],
+                self.reprojection_error[start_frame - first_frame:end_frame - first_frame],
+                visibility_mask,
+            )
+
+        store.save_edit_log(excluded_frame_ranges, undo_stack)
+        return store
@@ -21,3 +21,42 @@ def load_anipose_calibration_toml_from_path(
         print(f"Failed to load anipose calibration info from {str(camera_calibration_data_toml_path)}")
         raise e
 
+
+class CachedCalibration:
+    # A loaded calibration along with the per-camera arrays that triangulation and reprojection need
+    def __init__(self, camera_calibration_data_toml_path: Path, modification_time: float, anipose_calibration_object):
+        self.camera_calibration_data_toml_path = camera_calibration_data_toml_path
+        self.modification_time = modification_time
+        self.anipose_calibration_object = anipose_calibration_object
+        self.projection_parameters = anipose_calibration_object.get_projection_parameters()
+
+    @property
+    def projection_matrices(self):
+        return self.projection_parameters["extrinsics_matrices"]
+
+    @property
+    def camera_matrices(self):
+        return self.projection_parameters["camera_matrices"]
+
+    @property
+    def distortions(self):
+        return self.projection_parameters["distortions"]
+
+
+calibration_cache = {}
+
+
+def load_cached_anipose_calibration(
+        camera_calibration_data_toml_path: Union[str, Path],
+) -> CachedCalibration:
+    # Only reparse the TOML if it is new to us or has been modified since it was loaded
+    camera_calibration_data_toml_path = Path(camera_calibration_data_toml_path).resolve()
+    modification_time = camera_calibration_data_toml_path.stat().st_mtime
+
+    cached_calibration = calibration_cache.get(camera_calibration_data_toml_path)
+    if cached_calibration is None or cached_calibration.modification_time != modification_time:
+        anipose_calibration_object = load_anipose_calibration_toml_from_path(camera_calibration_data_toml_path)
+        cached_calibration = CachedCalibration(camera_calibration_data_toml_path, modification_time, anipose_calibration_object)
+        calibration_cache[camera_calibration_data_toml_path] = cached_calibration
+
+    return cached_calibration
@@ -18,11 +18,11 @@ from aniposelib.boards import (
     merge_rows,
 )
 from aniposelib.utils import get_connections, get_initial_extrinsics, get_rtvec, make_M
-from numba import jit
+from numba import jit, prange
 from scipy import optimize
 from scipy import signal
 from scipy.sparse import dok_matrix
-from tqdm import trange
+from tqdm import tqdm, trange
 
 numba_logger = logging.getLogger("numba")
 numba_logger.setLevel(logging.WARNING)
@@ -45,6 +45,72 @@ def triangulate_simple(points, camera_mats):
     return p3d
 
 
+@jit(nopython=True, parallel=True)
+def triangulate_points_parallel(points, camera_mats, visibility_mask):
+    """Given an undistorted CxNx2 array, the Cx3x4 array of camera extrinsics matrices and a CxN boolean visibility mask,
+    this returns an Nx3 array of points. Cameras that are masked out or have a NaN x coordinate are left out of that point's
+    DLT system and points seen by fewer than 2 cameras come back as NaN. Points are spread over all cores"""
+    n_cams, n_points, _ = points.shape
+    out = np.full((n_points, 3), np.nan)
+    for ip in prange(n_points):
+        n_good = 0
+        for i in range(n_cams):
+            if visibility_mask[i, ip] and not np.isnan(points[i, ip, 0]):
+                n_good += 1
+        if n_good < 2:
+            continue
+
+        A = np.zeros((n_good * 2, 4))
+        row = 0
+        for i in range(n_cams):
+            x = points[i, ip, 0]
+            if not visibility_mask[i, ip] or np.isnan(x):
+                continue
+            y = points[i, ip, 1]
+            for k in range(4):
+                A[row, k] = x * camera_mats[i, 2, k] - camera_mats[i, 0, k]
+                A[row + 1, k] = y * camera_mats[i, 2, k] - camera_mats[i, 1, k]
+            row += 2
+        u, s, vh = np.linalg.svd(A, full_matrices=True)
+        p3d = vh[-1]
+        out[ip, 0] = p3d[0] / p3d[3]
+        out[ip, 1] = p3d[1] / p3d[3]
+        out[ip, 2] = p3d[2] / p3d[3]
+    return out
+
+
+def triangulate_batch(points, camera_mats):
+    """Given an NxCx2 array of undistorted points that are all seen by the same C cameras,
+    and the Cx3x4 array of those cameras' extrinsics matrices, this returns an Nx3 array of points.
+    Builds the same DLT system as `triangulate_simple` for every point and solves them in one stacked SVD"""
+    n_points, n_cams, _ = points.shape
+    A = np.empty((n_points, n_cams * 2, 4))
+    A[:, 0::2] = points[:, :, 0, np.newaxis] * camera_mats[np.newaxis, :, 2] - camera_mats[np.newaxis, :, 0]
+    A[:, 1::2] = points[:, :, 1, np.newaxis] * camera_mats[np.newaxis, :, 2] - camera_mats[np.newaxis, :, 1]
+    u, s, vh = np.linalg.svd(A, full_matrices=True)
+    p3d = vh[:, -1]
+    p3d = p3d[:, :3] / p3d[:, 3:]
+    return p3d
+
+
+def group_points_by_visible_cameras(good):
+    """Given a CxN boolean array of which cameras see each point, this yields
+    (camera_indices, point_indices) for every set of cameras that sees at least one point"""
+    n_cams, n_points = good.shape
+    codes = np.zeros(n_points, dtype="int64")
+    for cnum in range(n_cams):
+        codes |= good[cnum].astype("int64") << cnum
+
+    order = np.argsort(codes, kind="stable")
+    sorted_codes = codes[order]
+    unique_codes, starts = np.unique(sorted_codes, return_index=True)
+    stops = np.append(starts[1:], n_points)
+
+    for code, start, stop in zip(unique_codes, starts, stops):
+        camera_indices = np.flatnonzero((code >> np.arange(n_cams)) & 1)
+        yield camera_indices, order[start:stop]
+
+
 def get_error_dict(errors_full, min_points=10):
     n_cams = errors_full.shape[0]
     errors_norm = np.linalg.norm(errors_full, axis=2)
@@ -189,6 +255,55 @@ def transform_points(points, rvecs, tvecs):
     return rotated + tvecs
 
 
+def rodrigues_to_rotation_matrices(rvecs):
+    """Given a Cx3 array of rotation vectors, this returns the Cx3x3 array of rotation matrices,
+    matching `cv2.Rodrigues`"""
+    rvecs = np.asarray(rvecs, dtype="float64").reshape(-1, 3)
+    theta = np.linalg.norm(rvecs, axis=1)
+    with np.errstate(invalid="ignore"):
+        v = rvecs / theta[:, np.newaxis]
+    v = np.nan_to_num(v)
+
+    zeros = np.zeros(len(rvecs))
+    skew = np.stack(
+        [
+            np.stack([zeros, -v[:, 2], v[:, 1]], axis=1),
+            np.stack([v[:, 2], zeros, -v[:, 0]], axis=1),
+            np.stack([-v[:, 1], v[:, 0], zeros], axis=1),
+        ],
+        axis=1,
+    )
+    cos_theta = np.cos(theta)[:, np.newaxis, np.newaxis]
+    sin_theta = np.sin(theta)[:, np.newaxis, np.newaxis]
+    outer = v[:, :, np.newaxis] * v[:, np.newaxis, :]
+
+    return cos_theta * np.eye(3) + sin_theta * skew + (1 - cos_theta) * outer
+
+
+def project_points_batch(points, rotation_matrices, tvecs, camera_matrices, distortions):
+    """Given an Nx3 array of points, and for C cameras the Cx3x3 rotation matrices, Cx3 translations,
+    Cx3x3 camera matrices and Cx5 Brown-Conrady distortions (k1, k2, p1, p2, k3),
+    this returns an CxNx2 array of 2D points. Matches `cv2.projectPoints` for every camera at once"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p_cam = np.einsum("cij,nj->cni", rotation_matrices, points) + tvecs[:, np.newaxis, :]
+        x = p_cam[:, :, 0] / p_cam[:, :, 2]
+        y = p_cam[:, :, 1] / p_cam[:, :, 2]
+        del p_cam
+
+        k1, k2, p1, p2, k3 = [distortions[:, i, np.newaxis] for i in range(5)]
+        r2 = x * x + y * y
+        radial = 1 + r2 * (k1 + r2 * (k2 + r2 * k3))
+        xy = x * y
+
+        out = np.empty(x.shape + (2,))
+        out[:, :, 0] = x * radial + 2 * p1 * xy + p2 * (r2 + 2 * x * x)
+        out[:, :, 1] = y * radial + p1 * (r2 + 2 * y * y) + 2 * p2 * xy
+
+    out[:, :, 0] = out[:, :, 0] * camera_matrices[:, 0, 0, np.newaxis] + camera_matrices[:, 0, 2, np.newaxis]
+    out[:, :, 1] = out[:, :, 1] * camera_matrices[:, 1, 1, np.newaxis] + camera_matrices[:, 1, 2, np.newaxis]
+    return out
+
+
 class Camera:
     def __init__(
         self,
@@ -471,6 +586,8 @@ class CameraGroup:
     def __init__(self, cameras, metadata={}):
         self.cameras = cameras
         self.metadata = metadata
+        self.projection_parameters = None
+        self.projection_parameters_key = None
 
     def subset_cameras(self, indices):
         cams = [self.cameras[ix].copy() for ix in indices]
@@ -493,15 +610,84 @@ class CameraGroup:
         n_points = points.shape[0]
         n_cams = len(self.cameras)
 
+        if self.can_project_batch():
+            return self.project_batch(points.reshape(n_points, 3))
+
         out = np.empty((n_cams, n_points, 2), dtype="float64")
         for cnum, cam in enumerate(self.cameras):
             out[cnum] = cam.project(points).reshape(n_points, 2)
 
         return out
 
-    def triangulate(self, points, undistort=True, progress=False, kill_event:multiprocessing.Event=None):
+    def can_project_batch(self):
+        """The batched projection only models the pinhole camera with up to 5 Brown-Conrady distortion
+        coefficients, fisheye cameras and rational/thin-prism models go through opencv one camera at a time"""
+        return all(type(cam) is Camera and len(cam.get_distortions()) <= 5 for cam in self.cameras)
+
+    def get_projection_parameters(self):
+        """Returns a dict with the stacked extrinsics matrices (Cx4x4), rotation matrices (Cx3x3), translations (Cx3),
+        camera matrices (Cx3x3) and distortions (Cx5, zero padded) of every camera.
+        These are only rebuilt when one of the cameras' parameters has changed since the last call"""
+        key = tuple(
+            (
+                cam.get_rotation().tobytes(),
+                cam.get_translation().tobytes(),
+                cam.get_camera_matrix().tobytes(),
+                cam.get_distortions().tobytes(),
+            )
+            for cam in self.cameras
+        )
+        if key == self.projection_parameters_key:
+            return self.projection_parameters
+
+        n_dist = max([5] + [len(cam.get_distortions()) for cam in self.cameras])
+        distortions = np.zeros((len(self.cameras), n_dist), dtype="float64")
+        for cnum, cam in enumerate(self.cameras):
+            dist = cam.get_distortions()
+            distortions[cnum, : len(dist)] = dist
+
+        self.projection_parameters = {
+            "extrinsics_matrices": np.array([cam.get_extrinsics_mat() for cam in self.cameras]).reshape(-1, 4, 4),
+            "rotation_matrices": rodrigues_to_rotation_matrices(self.get_rotations()),
+            "translations": self.get_translations().reshape(-1, 3),
+            "camera_matrices": np.array([cam.get_camera_matrix() for cam in self.cameras]).reshape(-1, 3, 3),
+            "distortions": distortions,
+        }
+        self.projection_parameters_key = key
+        return self.projection_parameters
+
+    def project_batch(self, points, batch_size=65536, camera_indices=None):
+        """Given an Nx3 array of points, this returns an CxNx2 array of 2D points,
+        projecting into every camera with batched numpy computations instead of `cv2.projectPoints` per camera.
+        Points are projected `batch_size` at a time to keep the temporaries small.
+        If `camera_indices` is given, only those cameras are projected into"""
+        if camera_indices is None:
+            camera_indices = np.arange(len(self.cameras))
+
+        projection_parameters = self.get_projection_parameters()
+        rotation_matrices = projection_parameters["rotation_matrices"][camera_indices]
+        tvecs = projection_parameters["translations"][camera_indices]
+        camera_matrices = projection_parameters["camera_matrices"][camera_indices]
+        distortions = projection_parameters["distortions"][camera_indices, :5]
+
+        n_points = points.shape[0]
+        out = np.empty((len(camera_indices), n_points, 2), dtype="float64")
+        for batch_start in range(0, n_points, batch_size):
+            batch = slice(batch_start, batch_start + batch_size)
+            out[:, batch] = project_points_batch(points[batch], rotation_matrices, tvecs, camera_matrices, distortions)
+
+        return out
+
+    def triangulate(self, points, undistort=True, progress=False, kill_event:multiprocessing.Event=None, batch_size=65536, method="batch", progress_callback=None, visibility_mask=None):
         """Given an CxNx2 array, this returns an Nx3 array of points,
-        where N is the number of points and C is the number of cameras"""
+        where N is the number of points and C is the number of cameras.
+        `method` picks the triangulation backend:
+            "batch": points are grouped by which cameras see them and each group is solved with a stacked SVD
+            "numba": the whole array is handed to the compiled `triangulate_points_parallel` kernel
+        Either backend works through `batch_size` points at a time so `kill_event` and `progress` stay responsive,
+        and calls `progress_callback(number_of_points_done, number_of_points)` after every batch if one is given.
+        An optional CxN boolean `visibility_mask` leaves out the masked cameras of each point without touching `points`.
+        If the numba kernel fails, this falls back to the "batch" backend"""
 
         assert points.shape[0] == len(
             self.cameras
@@ -513,6 +699,8 @@ class CameraGroup:
         if len(points.shape) == 2:
             points = points.reshape(-1, 1, 2)
             one_point = True
+            if visibility_mask is not None:
+                visibility_mask = visibility_mask.reshape(-1, 1)
 
         if undistort:
             new_points = np.empty(points.shape)
@@ -524,27 +712,101 @@ class CameraGroup:
 
         n_cams, n_points, _ = points.shape
 
+        if visibility_mask is None:
+            visibility_mask = np.ones((n_cams, n_points), dtype="bool")
+
+        cam_mats = self.get_projection_parameters()["extrinsics_matrices"]
+
+        out = None
+        if method == "numba":
+            try:
+                out = self._triangulate_numba(points, cam_mats, visibility_mask, progress, kill_event, batch_size, progress_callback)
+            except Exception as e:
+                logger.warning(f"Numba triangulation failed ({e}), falling back to batched triangulation")
+                out = self._triangulate_batch(points, cam_mats, visibility_mask, progress, kill_event, batch_size, progress_callback)
+        elif method == "batch":
+            out = self._triangulate_batch(points, cam_mats, visibility_mask, progress, kill_event, batch_size, progress_callback)
+        else:
+            raise ValueError(f"Unknown triangulation method: {method}")
+
+        if out is None:
+            return None
+
+        if one_point:
+            out = out[0]
+
+        return out
+
+    def _triangulate_batch(self, points, cam_mats, visibility_mask, progress, kill_event, batch_size, progress_callback=None):
+        """Triangulates an undistorted CxNx2 array one visible-camera group at a time,
+        returns None if `kill_event` gets set"""
+        n_cams, n_points, _ = points.shape
+
         out = np.empty((n_points, 3))
         out[:] = np.nan
 
-        cam_mats = np.array([cam.get_extrinsics_mat() for cam in self.cameras])
+        good = ~np.isnan(points[:, :, 0]) & visibility_mask
 
-        if progress:
-            iterator = trange(n_points, ncols=70)
-        else:
-            iterator = range(n_points)
+        progress_bar = tqdm(total=n_points, ncols=70) if progress else None
+        n_points_done = 0
+
+        for camera_indices, point_indices in group_points_by_visible_cameras(good):
+            if len(camera_indices) < 2:
+                n_points_done += len(point_indices)
+                if progress_bar is not None:
+                    progress_bar.update(len(point_indices))
+                continue
+
+            for batch_start in range(0, len(point_indices), batch_size):
+                batch = point_indices[batch_start : batch_start + batch_size]
+                subp = points[np.ix_(camera_indices, batch)].transpose(1, 0, 2)
+                out[batch] = triangulate_batch(subp, cam_mats[camera_indices])
+
+                n_points_done += len(batch)
+                if progress_bar is not None:
+                    progress_bar.update(len(batch))
+                if progress_callback is not None:
+                    progress_callback(n_points_done, n_points)
+
+                if kill_event is not None and kill_event.is_set():
+                    if progress_bar is not None:
+                        progress_bar.close()
+                    return None
+
+        if progress_bar is not None:
+            progress_bar.close()
 
-        for ip in iterator:
-            subp = points[:, ip, :]
-            good = ~np.isnan(subp[:, 0])
-            if np.sum(good) >= 2:
-                out[ip] = triangulate_simple(subp[good], cam_mats[good])
+        return out
+
+    def _triangulate_numba(self, points, cam_mats, visibility_mask, progress, kill_event, batch_size, progress_callback=None):
+        """Triangulates an undistorted CxNx2 array with the parallel numba kernel,
+        returns None if `kill_event` gets set"""
+        n_cams, n_points, _ = points.shape
+
+        out = np.empty((n_points, 3))
+
+        points = np.ascontiguousarray(points, dtype="float64")
+        cam_mats = np.ascontiguousarray(cam_mats, dtype="float64")
+        visibility_mask = np.ascontiguousarray(visibility_mask, dtype="bool")
+
+        progress_bar = tqdm(total=n_points, ncols=70) if progress else None
+
+        for batch_start in range(0, n_points, batch_size):
+            batch_stop = min(batch_start + batch_size, n_points)
+            out[batch_start:batch_stop] = triangulate_points_parallel(points[:, batch_start:batch_stop], cam_mats, visibility_mask[:, batch_start:batch_stop])
+
+            if progress_bar is not None:
+                progress_bar.update(batch_stop - batch_start)
+            if progress_callback is not None:
+                progress_callback(batch_stop, n_points)
 
             if kill_event is not None and kill_event.is_set():
+                if progress_bar is not None:
+                    progress_bar.close()
                 return None
 
-        if one_point:
-            out = out[0]
+        if progress_bar is not None:
+            progress_bar.close()
 
         return out
 
@@ -636,9 +898,14 @@ class CameraGroup:
         # return out, picked_vals, points_2d, errors #original code from OG anipose
         return out  # simplify output so that `triangulate_ransac` can be used exactly the same way as `triangulate`
 
-    def triangulate_ransac(self, points, undistort=True, min_cams=2, progress=False, kill_event:multiprocessing.Event=None):
+    def triangulate_ransac(self, points, undistort=True, min_cams=2, progress=False, threshold=0.5, kill_event:multiprocessing.Event=None):
         """Given an CxNx2 array, this returns an Nx3 array of points,
-        where N is the number of points and C is the number of cameras"""
+        where N is the number of points and C is the number of cameras.
+        Gives the same result as `triangulate_possible` with one option per point: every subset of the cameras
+        that see a point is tried in the same order, and the one with the lowest mean reprojection error wins,
+        stopping early once an error is under `threshold`.
+        Points seen by the same cameras are handled together, so each camera subset is enumerated once per
+        visibility mask and triangulated and reprojected for all of that mask's points in one batch"""
 
         assert points.shape[0] == len(
             self.cameras
@@ -648,16 +915,71 @@ class CameraGroup:
 
         n_cams, n_points, _ = points.shape
 
-        points_ransac = points.reshape(n_cams, n_points, 1, 2)
+        if undistort:
+            undistorted_points = np.empty(points.shape)
+            for cnum, cam in enumerate(self.cameras):
+                # must copy in order to satisfy opencv underneath
+                undistorted_points[cnum] = cam.undistort_points(np.copy(points[cnum]))
+        else:
+            undistorted_points = points
 
-        return self.triangulate_possible(points_ransac, undistort=undistort, min_cams=min_cams, progress=progress, kill_event=kill_event)
+        cam_mats = self.get_projection_parameters()["extrinsics_matrices"]
 
-    @jit(parallel=True, forceobj=True)
-    def reprojection_error(self, p3ds, p2ds, mean=False):
+        out = np.full((n_points, 3), np.nan, dtype="float64")
+        good = ~np.isnan(points[:, :, 0])
+
+        groups = list(group_points_by_visible_cameras(good))
+        if progress:
+            groups = tqdm(groups, ncols=70)
+
+        for camera_indices, point_indices in groups:
+            n_visible = len(camera_indices)
+            best_error = np.full(len(point_indices), 200.0)
+            done = np.zeros(len(point_indices), dtype="bool")
+
+            # Same order as itertools.product over [picked, None] per visible camera in `triangulate_possible`
+            for subset_number in range(2**n_visible):
+                picked = [
+                    camera_indices[i] for i in range(n_visible) if not (subset_number >> (n_visible - 1 - i)) & 1
+                ]
+                if len(picked) < min_cams and len(picked) != n_visible:
+                    continue
+                # one camera can't be triangulated, and the empty set has nothing to reproject
+                if len(picked) < 2:
+                    continue
+
+                if kill_event is not None and kill_event.is_set():
+                    return None
+
+                todo = point_indices[~done]
+                p3ds = triangulate_batch(undistorted_points[np.ix_(picked, todo)].transpose(1, 0, 2), cam_mats[picked])
+                errors = self.reprojection_error(p3ds, points[np.ix_(picked, todo)], mean=True, camera_indices=picked)
+
+                todo_mask = ~done
+                better = np.zeros(len(point_indices), dtype="bool")
+                better[todo_mask] = errors < best_error[todo_mask]
+
+                best_error[better] = errors[better[todo_mask]]
+                out[point_indices[better]] = p3ds[better[todo_mask]]
+                done |= better & (best_error < threshold)
+
+                if np.all(done):
+                    break
+
+        return out
+
+    def reprojection_error(self, p3ds, p2ds, mean=False, camera_indices=None, visibility_mask=None):
         """Given an Nx3 array of 3D points and an CxNx2 array of 2D points,
         where N is the number of points and C is the number of cameras,
         this returns an CxNx2 array of errors.
-        Optionally mean=True, this averages the errors and returns array of length N of errors"""
+        Optionally mean=True, this averages the errors and returns array of length N of errors.
+        If `camera_indices` is given, the 2D points only cover those cameras (in that order).
+        Errors of cameras that are False in an optional CxN `visibility_mask` come back as NaN"""
+
+        if camera_indices is None:
+            cameras = self.cameras
+        else:
+            cameras = [self.cameras[ix] for ix in camera_indices]
 
         one_point = False
         if len(p3ds.shape) == 1 and len(p2ds.shape) == 2:
@@ -671,10 +993,17 @@ class CameraGroup:
             3,
         ), "shapes of 2D and 3D points are not consistent: " "2D={}, 3D={}".format(p2ds.shape, p3ds.shape)
 
-        errors = np.empty((n_cams, n_points, 2))
+        if self.can_project_batch():
+            errors = self.project_batch(p3ds, camera_indices=camera_indices)
+            np.subtract(p2ds, errors, out=errors)
+        else:
+            errors = np.empty((n_cams, n_points, 2))
 
-        for cnum, cam in enumerate(self.cameras):
-            errors[cnum] = cam.single_camera_reprojection_error(p3ds, p2ds[cnum])
+            for cnum, cam in enumerate(cameras):
+                errors[cnum] = cam.single_camera_reprojection_error(p3ds, p2ds[cnum])
+
+        if visibility_mask is not None:
+            errors[~visibility_mask.reshape(n_cams, n_points)] = np.nan
 
         if mean:
             errors_norm = np.linalg.norm(errors, axis=2)
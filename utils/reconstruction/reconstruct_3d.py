@@ -1,79 +1,497 @@
+import logging
+
 import numpy as np
-from utils.reconstruction.anipose_object_loader import load_anipose_calibration_toml_from_path
+from utils.reconstruction.anipose_object_loader import load_cached_anipose_calibration
+from utils.reconstruction.undistortion_cache import UndistortionCache
 import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+logger = logging.getLogger(__name__)
 
 
-def process_2d_data_to_3d(mediapipe_2d_data: np.ndarray, calibration_toml_path: str, mediapipe_confidence_cutoff_threshold: float, kill_event: multiprocessing.Event = None):
-    # Load calibration object
-    anipose_calibration_object = load_anipose_calibration_toml_from_path(calibration_toml_path)
+def process_2d_data_to_3d(mediapipe_2d_data: np.ndarray, calibration_toml_path: str, mediapipe_confidence_cutoff_threshold: float, kill_event: multiprocessing.Event = None, undistortion_cache: UndistortionCache = None, start_frame: int = 0, progress_callback=None, number_of_processes: int = 1, frames_per_chunk: int = None, reprojection_error_filter_settings: "ReprojectionErrorFilterSettings" = None, mediapipe_confidence_data: np.ndarray = None, chunk_callback=None, joint_nums: np.ndarray = None, show_progress: bool = True):
+    # chunk_callback(start_frame, end_frame, spatial_data3d, reprojection_error_data3d) gets each block of frames as soon as it is reconstructed,
+    # so results can be streamed out (e.g. into a ReconstructionStore) while the rest of the frames are still being worked on.
+    # Long sessions can be split into frame chunks that are reconstructed in parallel processes
+    if number_of_processes > 1:
+        return process_2d_data_to_3d_in_chunks(
+            mediapipe_2d_data=mediapipe_2d_data,
+            mediapipe_confidence_data=mediapipe_confidence_data,
+            calibration_toml_path=calibration_toml_path,
+            mediapipe_confidence_cutoff_threshold=mediapipe_confidence_cutoff_threshold,
+            number_of_processes=number_of_processes,
+            frames_per_chunk=frames_per_chunk,
+            kill_event=kill_event,
+            progress_callback=progress_callback,
+            reprojection_error_filter_settings=reprojection_error_filter_settings,
+            chunk_callback=chunk_callback,
+            show_progress=show_progress,
+        )
+
+    # Load calibration object (only parsed again if the TOML changed since the last reconstruction)
+    anipose_calibration_object = load_cached_anipose_calibration(calibration_toml_path).anipose_calibration_object
 
     # 3D reconstruction
     spatial_data3d, reprojection_error_data3d = triangulate_3d_data(
         anipose_calibration_object=anipose_calibration_object,
         mediapipe_2d_data=mediapipe_2d_data,
+        mediapipe_confidence_data=mediapipe_confidence_data,
         mediapipe_confidence_cutoff_threshold=mediapipe_confidence_cutoff_threshold,
         kill_event=kill_event,
+        undistortion_cache=undistortion_cache,
+        start_frame=start_frame,
+        joint_nums=joint_nums,
+        progress_callback=progress_callback,
+        reprojection_error_filter_settings=reprojection_error_filter_settings,
+        show_progress=show_progress,
     )
 
     # Handle output
     # (You'll need to fill in this part with whatever you want to do with the results)
+    if chunk_callback is not None and spatial_data3d is not None:
+        chunk_callback(0, len(spatial_data3d), spatial_data3d, reprojection_error_data3d)
     return spatial_data3d, reprojection_error_data3d
 
 
+def process_2d_data_to_3d_in_chunks(
+    mediapipe_2d_data: np.ndarray,
+    calibration_toml_path: str,
+    mediapipe_confidence_cutoff_threshold: float,
+    number_of_processes: int = None,
+    frames_per_chunk: int = None,
+    kill_event: multiprocessing.Event = None,
+    progress_callback=None,
+    reprojection_error_filter_settings: "ReprojectionErrorFilterSettings" = None,
+    mediapipe_confidence_data: np.ndarray = None,
+    chunk_callback=None,
+    show_progress: bool = True,
+):
+    # Splits the frame axis into chunks that are triangulated and scored in a process pool.
+    # The 2D data and the outputs live in shared memory, so workers read their frames and write their results in place instead of pickling them
+    number_of_cameras, number_of_frames, number_of_tracked_points, _ = mediapipe_2d_data.shape
+    if number_of_processes is None:
+        number_of_processes = os.cpu_count()
+    if frames_per_chunk is None:
+        # A few chunks per process keeps the workers busy when some chunks are faster than others
+        frames_per_chunk = max(1, int(np.ceil(number_of_frames / (number_of_processes * 4))))
+
+    shared_2d_data = SharedArray.create(mediapipe_2d_data.shape)
+    shared_3d_data = SharedArray.create((number_of_frames, number_of_tracked_points, 3))
+    shared_reprojection_error = SharedArray.create((number_of_frames, number_of_tracked_points))
+    shared_arrays = [shared_2d_data, shared_3d_data, shared_reprojection_error]
+
+    # The confidence plane is shared in its own compact dtype
+    shared_confidence_data = None
+    if mediapipe_confidence_data is not None:
+        shared_confidence_data = SharedArray.create(mediapipe_confidence_data.shape, dtype=mediapipe_confidence_data.dtype)
+        shared_arrays.append(shared_confidence_data)
+
+    try:
+        shared_2d_data.array[:] = mediapipe_2d_data
+        if shared_confidence_data is not None:
+            shared_confidence_data.array[:] = mediapipe_confidence_data
+
+        with ProcessPoolExecutor(
+            max_workers=number_of_processes,
+            initializer=initialize_reconstruction_worker,
+            initargs=(calibration_toml_path,),
+        ) as executor:
+            def run_chunks(chunk_reprojection_error_filter_settings, filter_only=False, per_joint_reprojection_error_threshold=None):
+                # Returns False if the reconstruction was cancelled through the kill event
+                futures = {
+                    executor.submit(
+                        reconstruct_chunk,
+                        shared_2d_data.description,
+                        shared_3d_data.description,
+                        shared_reprojection_error.description,
+                        chunk_start_frame,
+                        min(chunk_start_frame + frames_per_chunk, number_of_frames),
+                        mediapipe_confidence_cutoff_threshold,
+                        chunk_reprojection_error_filter_settings,
+                        shared_confidence_data.description if shared_confidence_data is not None else None,
+                        filter_only,
+                        per_joint_reprojection_error_threshold,
+                        show_progress,
+                    ): chunk_start_frame
+                    for chunk_start_frame in range(0, number_of_frames, frames_per_chunk)
+                }
+
+                number_of_frames_done = 0
+                for future in as_completed(futures):
+                    number_of_chunk_frames = future.result()
+                    number_of_frames_done += number_of_chunk_frames
+
+                    # The chunks are only final once they've been through the filter
+                    if chunk_callback is not None and (filter_only or not filters_after_stitching):
+                        chunk_start_frame = futures[future]
+                        chunk_end_frame = chunk_start_frame + number_of_chunk_frames
+                        chunk_callback(
+                            chunk_start_frame,
+                            chunk_end_frame,
+                            shared_3d_data.array[chunk_start_frame:chunk_end_frame],
+                            shared_reprojection_error.array[chunk_start_frame:chunk_end_frame],
+                        )
+
+                    if progress_callback is not None and not filter_only:
+                        progress_callback(number_of_frames_done * number_of_tracked_points, number_of_frames * number_of_tracked_points)
+
+                    if kill_event is not None and kill_event.is_set():
+                        for pending_future in futures:
+                            pending_future.cancel()
+                        return False
+                return True
+
+            # Per joint thresholds have to come from the whole session's errors for the result to match a single process reconstruction,
+            # so with them every chunk is triangulated first and the chunks are only filtered once all of their errors are in
+            filters_after_stitching = reprojection_error_filter_settings is not None and reprojection_error_filter_settings.per_joint_percentile is not None
+            if filters_after_stitching:
+                if not run_chunks(None):
+                    return None, None
+                per_joint_reprojection_error_threshold = np.nanpercentile(
+                    shared_reprojection_error.array, reprojection_error_filter_settings.per_joint_percentile, axis=0
+                )
+                if not run_chunks(reprojection_error_filter_settings, filter_only=True, per_joint_reprojection_error_threshold=per_joint_reprojection_error_threshold):
+                    return None, None
+            elif not run_chunks(reprojection_error_filter_settings):
+                return None, None
+
+        return shared_3d_data.array.copy(), shared_reprojection_error.array.copy()
+    finally:
+        for shared_array in shared_arrays:
+            shared_array.release(unlink=True)
+
+
+class SharedArray:
+    # A numpy array backed by a named shared memory block, which other processes can attach to by its description
+    def __init__(self, shared_memory_block, shape, dtype="float64"):
+        self.shared_memory_block = shared_memory_block
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=shared_memory_block.buf)
+
+    @classmethod
+    def create(cls, shape, dtype="float64"):
+        size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+        return cls(shared_memory.SharedMemory(create=True, size=size), shape, dtype)
+
+    @classmethod
+    def attach(cls, description):
+        name, shape, dtype = description
+        return cls(shared_memory.SharedMemory(name=name), shape, dtype)
+
+    @property
+    def description(self):
+        return self.shared_memory_block.name, self.shape, self.dtype.str
+
+    def release(self, unlink=False):
+        del self.array
+        self.shared_memory_block.close()
+        if unlink:
+            self.shared_memory_block.unlink()
+
+
+# Each worker process loads the calibration once and reuses it for every chunk it gets
+worker_anipose_calibration_object = None
+
+
+def initialize_reconstruction_worker(calibration_toml_path: str):
+    global worker_anipose_calibration_object
+    worker_anipose_calibration_object = load_cached_anipose_calibration(calibration_toml_path).anipose_calibration_object
+
+
+def reconstruct_chunk(
+    shared_2d_data_description,
+    shared_3d_data_description,
+    shared_reprojection_error_description,
+    start_frame: int,
+    end_frame: int,
+    mediapipe_confidence_cutoff_threshold: float,
+    reprojection_error_filter_settings: "ReprojectionErrorFilterSettings" = None,
+    shared_confidence_data_description=None,
+    filter_only: bool = False,
+    per_joint_reprojection_error_threshold: np.ndarray = None,
+    show_progress: bool = True,
+):
+    # With filter_only the chunk's already triangulated points are only run through the reprojection error filter
+    shared_2d_data = SharedArray.attach(shared_2d_data_description)
+    shared_3d_data = SharedArray.attach(shared_3d_data_description)
+    shared_reprojection_error = SharedArray.attach(shared_reprojection_error_description)
+    shared_arrays = [shared_2d_data, shared_3d_data, shared_reprojection_error]
+
+    mediapipe_confidence_data = None
+    if shared_confidence_data_description is not None:
+        shared_confidence_data = SharedArray.attach(shared_confidence_data_description)
+        shared_arrays.append(shared_confidence_data)
+        mediapipe_confidence_data = shared_confidence_data.array[:, start_frame:end_frame]
+
+    try:
+        if filter_only:
+            mediapipe_2d_data = shared_2d_data.array[:, start_frame:end_frame]
+            spatial_data3d, reprojection_error_data3d, filtering_report = remove_3d_data_with_high_reprojection_error(
+                data3d_numFrames_numTrackedPoints_XYZ=shared_3d_data.array[start_frame:end_frame],
+                data3d_numFrames_numTrackedPoints_reprojectionError=shared_reprojection_error.array[start_frame:end_frame],
+                anipose_calibration_object=worker_anipose_calibration_object,
+                mediapipe_2d_data=mediapipe_2d_data,
+                reprojection_error_filter_settings=reprojection_error_filter_settings,
+                visibility_mask=threshold_by_confidence(mediapipe_2d_data, mediapipe_confidence_data, mediapipe_confidence_cutoff_threshold),
+                per_joint_reprojection_error_threshold=per_joint_reprojection_error_threshold,
+            )
+            log_filtering_report(filtering_report)
+        else:
+            spatial_data3d, reprojection_error_data3d = triangulate_3d_data(
+                anipose_calibration_object=worker_anipose_calibration_object,
+                mediapipe_2d_data=shared_2d_data.array[:, start_frame:end_frame],
+                mediapipe_confidence_data=mediapipe_confidence_data,
+                mediapipe_confidence_cutoff_threshold=mediapipe_confidence_cutoff_threshold,
+                reprojection_error_filter_settings=reprojection_error_filter_settings,
+                show_progress=show_progress,
+            )
+        shared_3d_data.array[start_frame:end_frame] = spatial_data3d
+        shared_reprojection_error.array[start_frame:end_frame] = reprojection_error_data3d
+    finally:
+        for shared_array in shared_arrays:
+            shared_array.release()
+
+    return end_frame - start_frame
+
+
 def triangulate_3d_data(
     anipose_calibration_object,
     mediapipe_2d_data: np.ndarray,
     mediapipe_confidence_cutoff_threshold: float,
     kill_event: multiprocessing.Event = None,
+    undistortion_cache: UndistortionCache = None,
+    start_frame: int = 0,
+    progress_callback=None,
+    reprojection_error_filter_settings: "ReprojectionErrorFilterSettings" = None,
+    mediapipe_confidence_data: np.ndarray = None,
+    show_progress: bool = True,
+    joint_nums: np.ndarray = None,
 ):
+    # start_frame and joint_nums say where in the recording the 2D data comes from, which the undistortion cache needs
     # Validation
     number_of_cameras, number_of_frames, number_of_tracked_points, number_of_spatial_dimensions = mediapipe_2d_data.shape
     if number_of_spatial_dimensions != 2:
         raise ValueError(f"Expected 2D data, got {number_of_spatial_dimensions} dimensions")
 
-    mediapipe_2d_data = threshold_by_confidence(
+    # Low confidence points are masked out rather than overwritten, so the 2D data is never copied or modified
+    visibility_mask = threshold_by_confidence(
         mediapipe_2d_data=mediapipe_2d_data,
+        mediapipe_confidence_data=mediapipe_confidence_data,
         mediapipe_confidence_cutoff_threshold=mediapipe_confidence_cutoff_threshold,
     )
 
     # Reshape data to collapse across 'frames' so it becomes [number_of_cameras, number_of_2d_points(numFrames*numPoints), XY]
     data2d_flat = mediapipe_2d_data.reshape(number_of_cameras, -1, 2)
+    visibility_mask_flat = visibility_mask.reshape(number_of_cameras, -1)
+
+    # Triangulate, reusing the undistorted points of any frames a previous reconstruction already undistorted
+    if undistortion_cache is not None:
+        undistorted_2d_data = undistortion_cache.undistort(anipose_calibration_object, start_frame, start_frame + number_of_frames, joint_nums)
+        data3d_flat = anipose_calibration_object.triangulate(undistorted_2d_data.reshape(number_of_cameras, -1, 2), undistort=False, progress=show_progress, kill_event=kill_event, progress_callback=progress_callback, visibility_mask=visibility_mask_flat)
+    else:
+        data3d_flat = anipose_calibration_object.triangulate(data2d_flat, progress=show_progress, kill_event=kill_event, progress_callback=progress_callback, visibility_mask=visibility_mask_flat)
 
-    # Triangulate
-    data3d_flat = anipose_calibration_object.triangulate(data2d_flat, progress=True, kill_event=kill_event)
+    # Triangulation returns None when it gets cancelled through the kill event
+    if data3d_flat is None:
+        return None, None
 
     # Reshape the flat data back to [numFrames, numPoints, XYZ]
     spatial_data3d_numFrames_numTrackedPoints_XYZ = data3d_flat.reshape(number_of_frames, number_of_tracked_points, 3)
 
     # Compute reprojection error
-    data3d_reprojectionError_flat = anipose_calibration_object.reprojection_error(data3d_flat, data2d_flat, mean=True)
+    data3d_reprojectionError_flat = anipose_calibration_object.reprojection_error(data3d_flat, data2d_flat, mean=True, visibility_mask=visibility_mask_flat)
     reprojection_error_data3d_numFrames_numTrackedPoints = data3d_reprojectionError_flat.reshape(number_of_frames, number_of_tracked_points)
 
     # Filter data with high reprojection error
-    spatial_data3d_numFrames_numTrackedPoints_XYZ = remove_3d_data_with_high_reprojection_error(
+    (
+        spatial_data3d_numFrames_numTrackedPoints_XYZ,
+        reprojection_error_data3d_numFrames_numTrackedPoints,
+        filtering_report,
+    ) = remove_3d_data_with_high_reprojection_error(
         data3d_numFrames_numTrackedPoints_XYZ=spatial_data3d_numFrames_numTrackedPoints_XYZ,
         data3d_numFrames_numTrackedPoints_reprojectionError=reprojection_error_data3d_numFrames_numTrackedPoints,
+        anipose_calibration_object=anipose_calibration_object,
+        mediapipe_2d_data=mediapipe_2d_data,
+        reprojection_error_filter_settings=reprojection_error_filter_settings,
+        visibility_mask=visibility_mask,
     )
+    log_filtering_report(filtering_report)
 
     return spatial_data3d_numFrames_numTrackedPoints_XYZ, reprojection_error_data3d_numFrames_numTrackedPoints
 
 
+def log_filtering_report(filtering_report):
+    for pass_report in filtering_report:
+        logger.info(
+            f"Reprojection error filter pass {pass_report['pass']}: {pass_report['failed']} points failed, "
+            f"{pass_report['rescued']} rescued, {pass_report['dropped']} dropped"
+        )
+
+
 def threshold_by_confidence(
     mediapipe_2d_data: np.ndarray,
+    mediapipe_confidence_data: np.ndarray = None,
     mediapipe_confidence_cutoff_threshold: float = 0.0,
 ):
-    mediapipe_2d_data[mediapipe_2d_data <= mediapipe_confidence_cutoff_threshold] = np.NaN
+    # Returns a [numCams, numFrames, numTrackedPoints] mask of the points that are tracked and above the confidence cutoff.
+    # Without a confidence plane only the NaN'd out points are masked
+    visibility_mask = ~np.isnan(mediapipe_2d_data[..., 0])
+    if mediapipe_confidence_data is not None:
+        visibility_mask &= mediapipe_confidence_data > mediapipe_confidence_cutoff_threshold
+    return visibility_mask
 
-    number_of_nans = np.sum(np.isnan(mediapipe_2d_data))
-    number_of_points = np.prod(mediapipe_2d_data.shape)
-    percentage_that_are_nans = (np.sum(np.isnan(mediapipe_2d_data)) / number_of_points) * 100
+class ReprojectionErrorFilterSettings:
+    # Thresholds a triangulated point's reprojection error has to stay under, leave one as None to skip that check
+    def __init__(
+        self,
+        reprojection_error_threshold: float = None,
+        per_joint_percentile: float = None,
+        per_camera_reprojection_error_threshold=None,
+        number_of_passes: int = 1,
+    ):
+        self.reprojection_error_threshold = reprojection_error_threshold  # in pixels, on the mean error across cameras
+        self.per_joint_percentile = per_joint_percentile  # e.g. 95 drops the worst 5% of each joint's frames
+        self.per_camera_reprojection_error_threshold = per_camera_reprojection_error_threshold  # in pixels, a single value or one per camera
+        self.number_of_passes = number_of_passes  # how many times a failing point can have its worst camera dropped, 0 drops failing points straight away
+        if number_of_passes < 0:
+            raise ValueError(f"number_of_passes can't be negative, got {number_of_passes}")
+
+    def is_enabled(self):
+        return (
+            self.reprojection_error_threshold is not None
+            or self.per_joint_percentile is not None
+            or self.per_camera_reprojection_error_threshold is not None
+        )
 
-    return mediapipe_2d_data
 
 def remove_3d_data_with_high_reprojection_error(
     data3d_numFrames_numTrackedPoints_XYZ: np.ndarray,
     data3d_numFrames_numTrackedPoints_reprojectionError: np.ndarray,
+    anipose_calibration_object=None,
+    mediapipe_2d_data: np.ndarray = None,
+    reprojection_error_filter_settings: ReprojectionErrorFilterSettings = None,
+    visibility_mask: np.ndarray = None,
+    per_joint_reprojection_error_threshold: np.ndarray = None,
 ):
+    # Points that fail the filter get their worst camera dropped and are triangulated again, all failing points at once.
+    # Whatever still fails after the last pass (or can't lose a camera and keep 2) is set to NaN, with 0 passes failing points are NaN'd without a retry.
+    # Returns the filtered 3D data and reprojection errors, and a report of what each pass rescued or dropped
+    if reprojection_error_filter_settings is None or not reprojection_error_filter_settings.is_enabled():
+        return data3d_numFrames_numTrackedPoints_XYZ, data3d_numFrames_numTrackedPoints_reprojectionError, []
+
+    number_of_frames, number_of_tracked_points, _ = data3d_numFrames_numTrackedPoints_XYZ.shape
+    number_of_cameras = mediapipe_2d_data.shape[0]
+
+    data3d_flat = data3d_numFrames_numTrackedPoints_XYZ.reshape(-1, 3).copy()
+    reprojection_error_flat = data3d_numFrames_numTrackedPoints_reprojectionError.ravel().copy()
+    data2d_flat = mediapipe_2d_data.reshape(number_of_cameras, -1, 2)
+    visibility_mask_flat = visibility_mask.reshape(number_of_cameras, -1) if visibility_mask is not None else None
+    joint_indices = np.tile(np.arange(number_of_tracked_points), number_of_frames)
+
+    # The per joint thresholds come from the unfiltered errors, so retries are held to the same bar.
+    # They can be given when the data is only part of the session, so the thresholds still come from all of it
+    per_joint_threshold = per_joint_reprojection_error_threshold
+    if per_joint_threshold is None and reprojection_error_filter_settings.per_joint_percentile is not None:
+        per_joint_threshold = np.nanpercentile(
+            data3d_numFrames_numTrackedPoints_reprojectionError, reprojection_error_filter_settings.per_joint_percentile, axis=0
+        )
 
-    return data3d_numFrames_numTrackedPoints_XYZ
+    def find_failing(point_indices, data3d, reprojection_error, data2d, visibility_mask=None):
+        # Returns which of the given points fail the filter and their per camera reprojection errors
+        per_camera_error = np.linalg.norm(
+            anipose_calibration_object.reprojection_error(data3d, data2d, mean=False, visibility_mask=visibility_mask), axis=2
+        )
+        with np.errstate(invalid="ignore"):
+            failing = np.zeros(len(point_indices), dtype="bool")
+            if reprojection_error_filter_settings.reprojection_error_threshold is not None:
+                failing |= reprojection_error > reprojection_error_filter_settings.reprojection_error_threshold
+            if per_joint_threshold is not None:
+                failing |= reprojection_error > per_joint_threshold[joint_indices[point_indices]]
+            if reprojection_error_filter_settings.per_camera_reprojection_error_threshold is not None:
+                per_camera_threshold = np.broadcast_to(
+                    reprojection_error_filter_settings.per_camera_reprojection_error_threshold, (number_of_cameras,)
+                )
+                failing |= np.any(per_camera_error > per_camera_threshold[:, np.newaxis], axis=0)
+        return failing, per_camera_error
+
+    filtering_report = []
+
+    candidate_indices = np.flatnonzero(~np.isnan(reprojection_error_flat))
+    failing, per_camera_error = find_failing(
+        candidate_indices,
+        data3d_flat[candidate_indices],
+        reprojection_error_flat[candidate_indices],
+        data2d_flat[:, candidate_indices],
+        visibility_mask_flat[:, candidate_indices] if visibility_mask_flat is not None else None,
+    )
+    failing_indices = candidate_indices[failing]
+    failing_per_camera_error = per_camera_error[:, failing]
+
+    if reprojection_error_filter_settings.number_of_passes == 0:
+        # No retries, every failing point is dropped
+        data3d_flat[failing_indices] = np.nan
+        reprojection_error_flat[failing_indices] = np.nan
+        filtering_report.append({"pass": 0, "failed": len(failing_indices), "rescued": 0, "dropped": len(failing_indices)})
+
+    # Only the failing points get copied, with their masked cameras NaN'd so the retries can drop cameras from them
+    failing_data2d = data2d_flat[:, failing_indices].copy()
+    if visibility_mask_flat is not None:
+        failing_data2d[~visibility_mask_flat[:, failing_indices]] = np.nan
+
+    for pass_number in range(1, reprojection_error_filter_settings.number_of_passes + 1):
+        if len(failing_indices) == 0:
+            break
+
+        # Drop each failing point's worst camera, points that would be left with fewer than 2 cameras can't be rescued
+        number_of_cameras_left = np.sum(~np.isnan(failing_data2d[:, :, 0]), axis=0) - 1
+        worst_camera = np.argmax(np.nan_to_num(failing_per_camera_error, nan=-np.inf), axis=0)
+        failing_data2d[worst_camera, np.arange(len(failing_indices))] = np.nan
+
+        can_retry = number_of_cameras_left >= 2
+        retry_indices = failing_indices[can_retry]
+        retry_data2d = failing_data2d[:, can_retry]
+
+        if len(retry_indices) > 0:
+            retry_data3d = anipose_calibration_object.triangulate(retry_data2d)
+            retry_reprojection_error = anipose_calibration_object.reprojection_error(retry_data3d, retry_data2d, mean=True)
+            still_failing, retry_per_camera_error = find_failing(retry_indices, retry_data3d, retry_reprojection_error, retry_data2d)
+        else:
+            # opencv can't undistort an empty set of points
+            retry_data3d = np.empty((0, 3))
+            retry_reprojection_error = np.empty(0)
+            still_failing, retry_per_camera_error = np.zeros(0, dtype="bool"), np.empty((number_of_cameras, 0))
+
+        rescued = ~still_failing
+        data3d_flat[retry_indices[rescued]] = retry_data3d[rescued]
+        reprojection_error_flat[retry_indices[rescued]] = retry_reprojection_error[rescued]
+
+        if pass_number == reprojection_error_filter_settings.number_of_passes:
+            dropped_indices = failing_indices[~can_retry | np.isin(failing_indices, retry_indices[still_failing])]
+        else:
+            dropped_indices = failing_indices[~can_retry]
+        data3d_flat[dropped_indices] = np.nan
+        reprojection_error_flat[dropped_indices] = np.nan
+
+        filtering_report.append(
+            {
+                "pass": pass_number,
+                "failed": len(failing_indices),
+                "rescued": int(np.sum(rescued)),
+                "dropped": len(dropped_indices),
+            }
+        )
+
+        # The points that still fail go into the next pass with their remaining cameras
+        failing_indices = retry_indices[still_failing]
+        failing_per_camera_error = retry_per_camera_error[:, still_failing]
+        failing_data2d = retry_data2d[:, still_failing]
+
+    return (
+        data3d_flat.reshape(number_of_frames, number_of_tracked_points, 3),
+        reprojection_error_flat.reshape(number_of_frames, number_of_tracked_points),
+        filtering_report,
+    )
 
@@ -0,0 +1,210 @@
+import json
+import os
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+
+class ChunkedArray:
+    """A [numFrames, numTrackedPoints, ...] array on disk, split into frames x joints chunks that are each
+    zlib compressed into their own file. Any frame range can be read or written by only touching the chunks
+    it overlaps, and chunks that were never written read as the fill value."""
+
+    def __init__(self, folder_path, shape, dtype, chunk_shape, fill_value, compression_level=6):
+        self.folder_path = Path(folder_path)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.chunk_shape = tuple(chunk_shape)  # (frames per chunk, joints per chunk)
+        self.fill_value = fill_value
+        self.compression_level = compression_level
+
+    def get_metadata(self):
+        return {
+            'shape': list(self.shape),
+            'dtype': self.dtype.str,
+            'chunk_shape': list(self.chunk_shape),
+            'fill_value': self.fill_value,
+        }
+
+    def get_chunk_path(self, frame_chunk_num, joint_chunk_num):
+        return self.folder_path / f"{frame_chunk_num}.{joint_chunk_num}"
+
+    def read_chunk(self, frame_chunk_num, joint_chunk_num):
+        # Edge chunks are stored padded to the full chunk shape, so every chunk decompresses to the same shape
+        full_chunk_shape = self.chunk_shape + self.shape[2:]
+        chunk_path = self.get_chunk_path(frame_chunk_num, joint_chunk_num)
+        if not chunk_path.exists():
+            return np.full(full_chunk_shape, self.fill_value, dtype=self.dtype)
+        return np.frombuffer(zlib.decompress(chunk_path.read_bytes()), dtype=self.dtype).reshape(full_chunk_shape)
+
+    def write_chunk(self, frame_chunk_num, joint_chunk_num, chunk):
+        chunk_path = self.get_chunk_path(frame_chunk_num, joint_chunk_num)
+        temporary_path = chunk_path.with_name(chunk_path.name + '.tmp')
+        temporary_path.write_bytes(zlib.compress(np.ascontiguousarray(chunk).tobytes(), self.compression_level))
+        os.replace(temporary_path, chunk_path)
+
+    def read(self, start_frame=None, end_frame=None, joint_nums=None):
+        start_frame, end_frame, _ = slice(start_frame, end_frame).indices(self.shape[0])
+        end_frame = max(start_frame, end_frame)
+        joint_nums = np.arange(self.shape[1]) if joint_nums is None else np.asarray(joint_nums)
+        frames_per_chunk, joints_per_chunk = self.chunk_shape
+
+        data = np.empty((end_frame - start_frame, len(joint_nums)) + self.shape[2:], dtype=self.dtype)
+        joint_chunk_nums = joint_nums // joints_per_chunk
+        for frame_chunk_num in range(start_frame // frames_per_chunk, -(-end_frame // frames_per_chunk)):
+            chunk_start_frame = frame_chunk_num * frames_per_chunk
+            first_frame, last_frame = max(start_frame, chunk_start_frame), min(end_frame, chunk_start_frame + frames_per_chunk)
+            for joint_chunk_num in np.unique(joint_chunk_nums):
+                chunk = self.read_chunk(frame_chunk_num, joint_chunk_num)
+                columns = joint_chunk_nums == joint_chunk_num
+                data[first_frame - start_frame:last_frame - start_frame, columns] = chunk[
+                    first_frame - chunk_start_frame:last_frame - chunk_start_frame, joint_nums[columns] - joint_chunk_num * joints_per_chunk
+                ]
+        return data
+
+    def write(self, start_frame, data):
+        # Writes all the joints of frames [start_frame, start_frame + len(data)).
+        # Chunks the frames only partly cover are read back and merged, so blocks can come in any order
+        end_frame = start_frame + len(data)
+        if start_frame < 0 or end_frame > self.shape[0]:
+            raise ValueError(f"Frames {start_frame} to {end_frame} are outside the {self.shape[0]} frames of the store")
+        frames_per_chunk, joints_per_chunk = self.chunk_shape
+        number_of_tracked_points = self.shape[1]
+
+        for frame_chunk_num in range(start_frame // frames_per_chunk, -(-end_frame // frames_per_chunk)):
+            chunk_start_frame = frame_chunk_num * frames_per_chunk
+            first_frame, last_frame = max(start_frame, chunk_start_frame), min(end_frame, chunk_start_frame + frames_per_chunk)
+            covers_chunk = first_frame == chunk_start_frame and last_frame == min(chunk_start_frame + frames_per_chunk, self.shape[0])
+            for joint_chunk_num in range(-(-number_of_tracked_points // joints_per_chunk)):
+                first_joint = joint_chunk_num * joints_per_chunk
+                last_joint = min(first_joint + joints_per_chunk, number_of_tracked_points)
+                if covers_chunk:
+                    chunk = np.full(self.chunk_shape + self.shape[2:], self.fill_value, dtype=self.dtype)
+                else:
+                    chunk = self.read_chunk(frame_chunk_num, joint_chunk_num).copy()
+                chunk[first_frame - chunk_start_frame:last_frame - chunk_start_frame, :last_joint - first_joint] = data[
+                    first_frame - start_frame:last_frame - start_frame, first_joint:last_joint
+                ]
+                self.write_chunk(frame_chunk_num, joint_chunk_num, chunk)
+
+
+class ReconstructionStore:
+    """A folder holding a reconstruction's 3D positions, reprojection errors and visibility mask as chunked,
+    compressed arrays, along with the 2D edit log the reconstruction was made from. Frame numbers are counted
+    from the first reconstructed frame, which is kept as `start_frame`."""
+
+    metadata_file_name = 'metadata.json'
+    edit_log_file_name = 'edit_log.json'
+
+    def __init__(self, store_path, start_frame, arrays):
+        self.store_path = Path(store_path)
+        self.start_frame = start_frame
+        self.spatial_data = arrays['spatial_data']  # [numFrames, numTrackedPoints, XYZ]
+        self.reprojection_error = arrays['reprojection_error']  # [numFrames, numTrackedPoints]
+        self.visibility_mask = arrays['visibility_mask']  # [numFrames, numTrackedPoints, numCams], frames first so it chunks like the rest
+
+    @classmethod
+    def create(cls, store_path, number_of_cameras, number_of_frames, number_of_tracked_points, start_frame=0, frames_per_chunk=256, joints_per_chunk=16, compression_level=6):
+        # Any store already at the path is replaced
+        store_path = Path(store_path)
+        chunk_shape = (frames_per_chunk, joints_per_chunk)
+        array_specs = {
+            'spatial_data': ((number_of_frames, number_of_tracked_points, 3), np.float64, np.nan),
+            'reprojection_error': ((number_of_frames, number_of_tracked_points), np.float64, np.nan),
+            'visibility_mask': ((number_of_frames, number_of_tracked_points, number_of_cameras), np.bool_, False),
+        }
+
+        arrays = {}
+        for array_name, (shape, dtype, fill_value) in array_specs.items():
+            array_folder_path = store_path / array_name
+            array_folder_path.mkdir(parents=True, exist_ok=True)
+            for chunk_path in array_folder_path.iterdir():
+                chunk_path.unlink()
+            arrays[array_name] = ChunkedArray(array_folder_path, shape, dtype, chunk_shape, fill_value, compression_level)
+
+        store = cls(store_path, start_frame, arrays)
+        store.save_metadata()
+        (store_path / cls.edit_log_file_name).unlink(missing_ok=True)
+        return store
+
+    @classmethod
+    def open(cls, store_path):
+        store_path = Path(store_path)
+        metadata = json.loads((store_path / cls.metadata_file_name).read_text())
+        arrays = {
+            array_name: ChunkedArray(store_path / array_name, **array_metadata)
+            for array_name, array_metadata in metadata['arrays'].items()
+        }
+        return cls(store_path, metadata['start_frame'], arrays)
+
+    def save_metadata(self):
+        metadata = {
+            'start_frame': self.start_frame,
+            'arrays': {
+                'spatial_data': self.spatial_data.get_metadata(),
+                'reprojection_error': self.reprojection_error.get_metadata(),
+                'visibility_mask': self.visibility_mask.get_metadata(),
+            },
+        }
+        (self.store_path / self.metadata_file_name).write_text(json.dumps(metadata, indent=2))
+
+    def get_number_of_frames(self):
+        return self.spatial_data.shape[0]
+
+    def write_frames(self, start_frame, spatial_data3d, reprojection_error_data3d, visibility_mask=None):
+        # Takes a block of frames as the reconstruction returns them, visibility_mask being [numCams, numFrames, numTrackedPoints]
+        self.spatial_data.write(start_frame, spatial_data3d)
+        self.reprojection_error.write(start_frame, reprojection_error_data3d)
+        if visibility_mask is not None:
+            self.visibility_mask.write(start_frame, np.moveaxis(visibility_mask, 0, -1))
+
+    def read_spatial_data(self, start_frame=None, end_frame=None, joint_nums=None):
+        return self.spatial_data.read(start_frame, end_frame, joint_nums)
+
+    def read_reprojection_error(self, start_frame=None, end_frame=None, joint_nums=None):
+        return self.reprojection_error.read(start_frame, end_frame, joint_nums)
+
+    def read_visibility_mask(self, start_frame=None, end_frame=None, joint_nums=None):
+        # Returned as [numCams, numFrames, numTrackedPoints] like the 2D data
+        return np.moveaxis(self.visibility_mask.read(start_frame, end_frame, joint_nums), -1, 0)
+
+    def save_edit_log(self, excluded_frame_ranges, undo_stack=()):
+        # The exclusions and the edits that led to them, as JointDataHolder keeps them
+        edit_log = {
+            'excluded_frame_ranges': [
+                {'camera_num': int(camera_num), 'joint_num': int(joint_num), 'frame_ranges': [[int(start), int(end)] for start, end in frame_ranges]}
+                for (camera_num, joint_num), frame_ranges in excluded_frame_ranges.items()
+            ],
+            'edits': [
+                {
+                    'camera_num': int(camera_num),
+                    'joint_num': int(joint_num),
+                    'frame_ranges_before': [[int(start), int(end)] for start, end in previous_frame_ranges],
+                    'frame_ranges_after': [[int(start), int(end)] for start, end in frame_ranges],
+                }
+                for camera_num, joint_num, previous_frame_ranges, frame_ranges in undo_stack
+            ],
+        }
+        (self.store_path / self.edit_log_file_name).write_text(json.dumps(edit_log, indent=2))
+
+    def load_edit_log(self):
+        # Returns the exclusions and edits in the form save_edit_log takes them, or empty ones if no edit log was saved
+        edit_log_path = self.store_path / self.edit_log_file_name
+        if not edit_log_path.exists():
+            return {}, []
+        edit_log = json.loads(edit_log_path.read_text())
+        excluded_frame_ranges = {
+            (entry['camera_num'], entry['joint_num']): [tuple(frame_range) for frame_range in entry['frame_ranges']]
+            for entry in edit_log['excluded_frame_ranges']
+        }
+        undo_stack = [
+            (
+                entry['camera_num'],
+                entry['joint_num'],
+                [tuple(frame_range) for frame_range in entry['frame_ranges_before']],
+                [tuple(frame_range) for frame_range in entry['frame_ranges_after']],
+            )
+            for entry in edit_log['edits']
+        ]
+        return excluded_frame_ranges, undo_stack
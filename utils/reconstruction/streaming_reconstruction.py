@@ -0,0 +1,121 @@
+import collections
+import time
+from pathlib import Path
+from typing import Iterable, Union
+
+import numpy as np
+
+from utils.reconstruction.anipose_object_loader import load_cached_anipose_calibration
+from utils.reconstruction.reconstruct_3d import triangulate_3d_data, ReprojectionErrorFilterSettings
+
+
+class StreamingBlockResult:
+    # The reconstruction of one block of frames, with how long it took from the block coming in to its 3D data being ready
+    def __init__(self, start_frame, spatial_data3d, reprojection_error_data3d, latency):
+        self.start_frame = start_frame
+        self.end_frame = start_frame + len(spatial_data3d)
+        self.spatial_data3d = spatial_data3d  # [numFrames, numTrackedPoints, XYZ]
+        self.reprojection_error_data3d = reprojection_error_data3d  # [numFrames, numTrackedPoints]
+        self.latency = latency  # seconds
+
+
+class StreamingReconstructionStatistics:
+    # Running totals over every block so far. Only the most recent latencies are kept, so memory stays bounded however long the stream runs
+    def __init__(self, number_of_tracked_points, latency_window=1000):
+        self.number_of_blocks = 0
+        self.number_of_frames = 0
+        self.number_of_reconstructed_points = np.zeros(number_of_tracked_points, dtype=np.int64)
+        self.reprojection_error_sum = np.zeros(number_of_tracked_points)
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.recent_latencies = collections.deque(maxlen=latency_window)
+
+    def add_block(self, spatial_data3d, reprojection_error_data3d, latency):
+        reconstructed = ~np.isnan(spatial_data3d).any(axis=2) & ~np.isnan(reprojection_error_data3d)
+        self.number_of_blocks += 1
+        self.number_of_frames += len(spatial_data3d)
+        self.number_of_reconstructed_points += reconstructed.sum(axis=0)
+        self.reprojection_error_sum += np.where(reconstructed, reprojection_error_data3d, 0).sum(axis=0)
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        self.recent_latencies.append(latency)
+
+    def get_mean_latency(self):
+        return self.total_latency / self.number_of_blocks if self.number_of_blocks else 0.0
+
+    def get_latency_percentile(self, percentile):
+        # Over the recent latencies only
+        return float(np.percentile(self.recent_latencies, percentile)) if self.recent_latencies else 0.0
+
+    def get_frames_per_second(self):
+        return self.number_of_frames / self.total_latency if self.total_latency > 0 else 0.0
+
+    def get_reconstructed_fraction(self):
+        # Per joint, the fraction of frames that got a 3D point
+        return self.number_of_reconstructed_points / self.number_of_frames if self.number_of_frames else np.zeros_like(self.reprojection_error_sum)
+
+    def get_mean_reprojection_error(self):
+        # Per joint, over the frames that got a 3D point (NaN for joints that never did)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.reprojection_error_sum / self.number_of_reconstructed_points
+
+
+class StreamingReconstructor:
+    """Reconstructs 2D data a block of frames at a time as it comes in (e.g. from live capture), so only the
+    current block is ever held in memory. The calibration is loaded once and triangulation is warmed up
+    before the first block, so no block pays for parsing the TOML or compiling the triangulation kernel.
+    A per joint percentile filter only sees the current block, not the whole recording."""
+
+    def __init__(
+        self,
+        calibration_toml_path: Union[str, Path],
+        number_of_tracked_points: int,
+        mediapipe_confidence_cutoff_threshold: float = .5,
+        reprojection_error_filter_settings: ReprojectionErrorFilterSettings = None,
+        latency_window: int = 1000,
+    ):
+        self.calibration_toml_path = calibration_toml_path
+        self.mediapipe_confidence_cutoff_threshold = mediapipe_confidence_cutoff_threshold
+        self.reprojection_error_filter_settings = reprojection_error_filter_settings
+        self.anipose_calibration_object = load_cached_anipose_calibration(calibration_toml_path).anipose_calibration_object
+        self.statistics = StreamingReconstructionStatistics(number_of_tracked_points, latency_window)
+        self.next_frame = 0
+        self.warm_up()
+
+    def warm_up(self):
+        # Triangulates a single made up frame, which isn't counted in the statistics
+        number_of_cameras = len(self.anipose_calibration_object.cameras)
+        number_of_tracked_points = len(self.statistics.reprojection_error_sum)
+        triangulate_3d_data(
+            anipose_calibration_object=self.anipose_calibration_object,
+            mediapipe_2d_data=np.zeros((number_of_cameras, 1, number_of_tracked_points, 2)),
+            mediapipe_confidence_cutoff_threshold=self.mediapipe_confidence_cutoff_threshold,
+            reprojection_error_filter_settings=self.reprojection_error_filter_settings,
+            show_progress=False,
+        )
+
+    def reconstruct_block(self, mediapipe_2d_block: np.ndarray, mediapipe_confidence_block: np.ndarray = None) -> StreamingBlockResult:
+        # Takes a [numCams, numFrames, numTrackedPoints, XY] block following on from the previous one
+        block_start_time = time.perf_counter()
+        spatial_data3d, reprojection_error_data3d = triangulate_3d_data(
+            anipose_calibration_object=self.anipose_calibration_object,
+            mediapipe_2d_data=mediapipe_2d_block,
+            mediapipe_confidence_data=mediapipe_confidence_block,
+            mediapipe_confidence_cutoff_threshold=self.mediapipe_confidence_cutoff_threshold,
+            reprojection_error_filter_settings=self.reprojection_error_filter_settings,
+            show_progress=False,
+        )
+        latency = time.perf_counter() - block_start_time
+
+        self.statistics.add_block(spatial_data3d, reprojection_error_data3d, latency)
+        result = StreamingBlockResult(self.next_frame, spatial_data3d, reprojection_error_data3d, latency)
+        self.next_frame = result.end_frame
+        return result
+
+    def reconstruct_stream(self, blocks: Iterable):
+        # Yields a result for each block the iterable gives, which can be 2D blocks or (2D block, confidence block) pairs
+        for block in blocks:
+            if isinstance(block, tuple):
+                yield self.reconstruct_block(*block)
+            else:
+                yield self.reconstruct_block(block)
@@ -0,0 +1,86 @@
+from collections import OrderedDict
+
+import numpy as np
+
+
+class UndistortionCache:
+    """Keeps the undistorted points of a recording's original 2D data in blocks of frames, filled in the first
+    time a reconstruction touches them. Edits to the 2D data only mask points out, which triangulation does
+    through its visibility mask, so the undistorted originals never go stale and no copy of the raw data is
+    needed to spot changes. Everything is dropped if the calibration changes.
+    The least recently used blocks are evicted once the cache holds more than max_bytes, like the video FrameCache.
+    Blocks stay float64, so reconstructions give the same results with or without the cache."""
+
+    def __init__(self, original_2d_data: np.ndarray, frames_per_block: int = 256, max_bytes: int = 256 * 1024**2):
+        self.original_2d_data = original_2d_data  # [numCams, numFrames, numTrackedPoints, XY], usually a read only memory map
+        self.frames_per_block = frames_per_block
+        self.max_bytes = max_bytes
+        self.number_of_bytes = 0
+        self.calibration_key = None
+        self.undistorted_blocks = OrderedDict()  # block number -> [numCams, frames_per_block, numTrackedPoints, XY], least recently used first
+
+    def clear(self):
+        self.calibration_key = None
+        self.undistorted_blocks = OrderedDict()
+        self.number_of_bytes = 0
+
+    def undistort(self, anipose_calibration_object, start_frame: int, end_frame: int, joint_nums: np.ndarray = None):
+        """Returns the undistorted [numCams, numFrames, numTrackedPoints, XY] points of frames start_frame to end_frame
+        of the recording, for just the given joints if joint_nums is set"""
+        calibration_key = get_calibration_key(anipose_calibration_object)
+        if calibration_key != self.calibration_key:
+            self.clear()
+            self.calibration_key = calibration_key
+
+        number_of_cameras, _, number_of_tracked_points, _ = self.original_2d_data.shape
+        if joint_nums is None:
+            joint_nums = np.arange(number_of_tracked_points)
+
+        undistorted_2d_data = np.empty((number_of_cameras, end_frame - start_frame, len(joint_nums), 2))
+        for block_num in range(start_frame // self.frames_per_block, -(-end_frame // self.frames_per_block)):
+            block_start_frame = block_num * self.frames_per_block
+            undistorted_block = self.undistorted_blocks.get(block_num)
+            if undistorted_block is None:
+                undistorted_block = self._undistort_block(anipose_calibration_object, block_start_frame)
+                self._put(block_num, undistorted_block)
+            else:
+                self.undistorted_blocks.move_to_end(block_num)
+
+            first_frame, last_frame = max(start_frame, block_start_frame), min(end_frame, block_start_frame + len(undistorted_block[0]))
+            undistorted_2d_data[:, first_frame - start_frame:last_frame - start_frame] = undistorted_block[
+                :, first_frame - block_start_frame:last_frame - block_start_frame, joint_nums
+            ]
+
+        return undistorted_2d_data
+
+    def _put(self, block_num: int, undistorted_block: np.ndarray):
+        self.undistorted_blocks[block_num] = undistorted_block
+        self.number_of_bytes += undistorted_block.nbytes
+
+        # Always keep the newest block, even if it doesn't fit the budget on its own
+        while self.number_of_bytes > self.max_bytes and len(self.undistorted_blocks) > 1:
+            _, evicted_block = self.undistorted_blocks.popitem(last=False)
+            self.number_of_bytes -= evicted_block.nbytes
+
+    def _undistort_block(self, anipose_calibration_object, block_start_frame: int):
+        block_2d_data = np.asarray(self.original_2d_data[:, block_start_frame:block_start_frame + self.frames_per_block], dtype="float64")
+        undistorted_block = np.full(block_2d_data.shape, np.nan)
+
+        for camera_number, camera in enumerate(anipose_calibration_object.cameras):
+            points = block_2d_data[camera_number].reshape(-1, 2)
+
+            # Untracked points don't need to go through opencv
+            valid = ~np.isnan(points[:, 0])
+            if np.any(valid):
+                undistorted_points = undistorted_block[camera_number].reshape(-1, 2)
+                undistorted_points[valid] = camera.undistort_points(np.ascontiguousarray(points[valid]).reshape(-1, 1, 2)).reshape(-1, 2)
+
+        return undistorted_block
+
+
+def get_calibration_key(anipose_calibration_object):
+    # Undistortion only depends on the camera type, intrinsics and distortion coefficients
+    return tuple(
+        (type(camera).__name__, camera.get_camera_matrix().tobytes(), camera.get_distortions().tobytes())
+        for camera in anipose_calibration_object.cameras
+    )
@@ -0,0 +1,305 @@
+import bisect
+import logging
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class FrameCache:
+    # LRU cache of decoded frames, the least recently used frames are evicted once the cache holds more than max_bytes
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.number_of_bytes = 0
+        self.frames = OrderedDict()  # frame_num -> frame, least recently used first
+        self.lock = threading.Lock()
+
+    def __contains__(self, frame_num):
+        with self.lock:
+            return frame_num in self.frames
+
+    def get(self, frame_num):
+        with self.lock:
+            frame = self.frames.get(frame_num)
+            if frame is not None:
+                self.frames.move_to_end(frame_num)
+            return frame
+
+    def put(self, frame_num, frame):
+        with self.lock:
+            if frame_num in self.frames:
+                self.number_of_bytes -= self.frames.pop(frame_num).nbytes
+            self.frames[frame_num] = frame
+            self.number_of_bytes += frame.nbytes
+
+            # Always keep the newest frame, even if it doesn't fit the budget on its own
+            while self.number_of_bytes > self.max_bytes and len(self.frames) > 1:
+                _, evicted_frame = self.frames.popitem(last=False)
+                self.number_of_bytes -= evicted_frame.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.number_of_bytes = 0
+
+
+class FrameIndex:
+    # The exact frame count, keyframe numbers and frame size of a video, saved next to it so it's only built the first time the video is opened
+    def __init__(self, number_of_frames, keyframes, frame_width, frame_height, fps, video_size=None, video_modification_time=None):
+        self.number_of_frames = number_of_frames
+        self.keyframes = keyframes  # sorted frame numbers, or None if the backend can't tell which frames are keyframes
+        self.frame_width = frame_width
+        self.frame_height = frame_height
+        self.fps = fps
+        self.video_size = video_size
+        self.video_modification_time = video_modification_time
+
+    @staticmethod
+    def get_index_path(video_path):
+        video_path = Path(video_path)
+        return video_path.with_name(video_path.name + '.frame_index.npz')
+
+    @classmethod
+    def load_or_build(cls, video_path):
+        video_stat = os.stat(video_path)
+        index_path = cls.get_index_path(video_path)
+
+        # The saved index is only trusted if the video hasn't changed since it was built
+        if index_path.exists():
+            try:
+                with np.load(index_path) as saved_index:
+                    if int(saved_index['video_size']) == video_stat.st_size and int(saved_index['video_modification_time']) == video_stat.st_mtime_ns:
+                        keyframes = saved_index['keyframes'].tolist() if bool(saved_index['has_keyframes']) else None
+                        return cls(
+                            int(saved_index['number_of_frames']),
+                            keyframes,
+                            int(saved_index['frame_width']),
+                            int(saved_index['frame_height']),
+                            float(saved_index['fps']),
+                            video_stat.st_size,
+                            video_stat.st_mtime_ns,
+                        )
+            except (OSError, KeyError, ValueError) as e:
+                logger.warning(f"Rebuilding the unreadable frame index {index_path}: {e}")
+
+        frame_index = cls.build(video_path)
+        frame_index.video_size = video_stat.st_size
+        frame_index.video_modification_time = video_stat.st_mtime_ns
+        try:
+            frame_index.save(index_path)
+        except OSError as e:
+            logger.warning(f"Could not save the frame index {index_path}: {e}")
+        return frame_index
+
+    @classmethod
+    def build(cls, video_path):
+        # Reads the encoded packets without decoding them, which is far faster than decoding and exact unlike CAP_PROP_FRAME_COUNT.
+        # Backends that can't hand out raw packets fall back to grabbing (decoding) every frame, without keyframes
+        video = cv2.VideoCapture(str(video_path))
+        try:
+            frame_width = int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
+            frame_height = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            fps = video.get(cv2.CAP_PROP_FPS)
+
+            has_keyframes = video.set(cv2.CAP_PROP_FORMAT, -1)
+            number_of_frames = 0
+            keyframes = []
+            while video.grab():
+                if has_keyframes and video.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME):
+                    keyframes.append(number_of_frames)
+                number_of_frames += 1
+        finally:
+            video.release()
+
+        # A stream always starts on a keyframe, if none were flagged the backend doesn't report them
+        if not keyframes or keyframes[0] != 0:
+            has_keyframes = False
+        return cls(number_of_frames, keyframes if has_keyframes else None, frame_width, frame_height, fps)
+
+    def save(self, index_path):
+        # Written to a temporary file first, as the same index may be built by two threads at once
+        temporary_path = Path(index_path).with_name(Path(index_path).name + f'.{threading.get_ident()}.tmp')
+        with open(temporary_path, 'wb') as file:
+            self.save_to_file(file)
+        os.replace(temporary_path, index_path)
+
+    def save_to_file(self, file):
+        np.savez(
+            file,
+            number_of_frames=self.number_of_frames,
+            keyframes=np.array(self.keyframes if self.keyframes is not None else [], dtype=np.int64),
+            has_keyframes=self.keyframes is not None,
+            frame_width=self.frame_width,
+            frame_height=self.frame_height,
+            fps=self.fps,
+            video_size=self.video_size,
+            video_modification_time=self.video_modification_time,
+        )
+
+    def get_keyframe(self, frame_num):
+        # The last keyframe at or before the frame, decoding has to start from there
+        if self.keyframes is None:
+            return None
+        return self.keyframes[max(bisect.bisect_right(self.keyframes, frame_num) - 1, 0)]
+
+
+class VideoLoader:
+    def __init__(self, video_path, cache_size_bytes=512 * 1024**2, prefetch_ahead=30, prefetch_behind=10, max_sequential_skip=30):
+        self.video_path = video_path
+        self.frame_index = FrameIndex.load_or_build(video_path)
+        self.num_frames = self.frame_index.number_of_frames
+        self.frame_width = self.frame_index.frame_width
+        self.frame_height = self.frame_index.frame_height
+        self.fps = self.frame_index.fps
+
+        # The decoder is only opened when a frame is first needed, and is closed again by release() until the next one is
+        self.video = None
+
+        # Frames after the decoder's position in the same group of pictures are read forward to, anything else needs a seek.
+        # Without keyframes, frames up to max_sequential_skip ahead are read forward to instead
+        self.next_frame_num = 0  # the frame the next video.read() returns, None if unknown
+        self.max_sequential_skip = max_sequential_skip
+        self.capture_lock = threading.Lock()
+        self.frame_cache = FrameCache(cache_size_bytes)
+
+        # The prefetch thread decodes the frames around the last requested frame while the GUI is idle
+        self.prefetch_ahead = prefetch_ahead
+        self.prefetch_behind = prefetch_behind
+        self.requested_frame_num = None
+        self.prefetch_pending = False
+        self.prefetch_condition = threading.Condition()
+        self.stop_event = threading.Event()
+        self.prefetch_thread = None
+
+    def get_frame(self, frame_num):
+        # Move the prefetcher first, so it stops decoding around the old position
+        self.request_prefetch(frame_num)
+
+        frame = self.frame_cache.get(frame_num)
+        if frame is None:
+            frame = self.decode_frame(frame_num)
+        return frame
+
+    def decode_frame(self, frame_num):
+        with self.capture_lock:
+            # The prefetch thread may have decoded it while we were waiting for the capture
+            frame = self.frame_cache.get(frame_num)
+            if frame is not None:
+                return frame
+
+            if frame_num < 0 or frame_num >= self.num_frames:
+                raise ValueError(f"Frame {frame_num} is out of range for {self.video_path}")
+
+            if self.video is None:
+                self.video = cv2.VideoCapture(str(self.video_path))
+                self.next_frame_num = 0
+
+            # A seek decodes forward from the frame's keyframe inside the backend, so if the decoder is already between that keyframe
+            # and the frame it just reads forward. Seeking to the keyframe ourselves and grabbing forward decodes the same frames
+            # through the slower Python loop, so anything else seeks straight to the frame
+            keyframe = self.frame_index.get_keyframe(frame_num)
+            if self.next_frame_num is None:
+                can_read_forward = False
+            elif keyframe is None:
+                can_read_forward = 0 <= frame_num - self.next_frame_num <= self.max_sequential_skip
+            else:
+                can_read_forward = keyframe <= self.next_frame_num <= frame_num
+            if not can_read_forward:
+                self.video.set(cv2.CAP_PROP_POS_FRAMES, frame_num)
+                self.next_frame_num = frame_num
+            while self.next_frame_num < frame_num:
+                self.video.grab()
+                self.next_frame_num += 1
+
+            # Read the current frame
+            success, frame = self.video.read()
+            if not success:
+                self.next_frame_num = None
+                raise ValueError(f"Could not read frame {frame_num} of {self.video_path}")
+            self.next_frame_num += 1
+
+            # Convert the frame from BGR to RGB
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            self.frame_cache.put(frame_num, frame)
+            return frame
+
+    def request_prefetch(self, frame_num):
+        if self.prefetch_thread is None:
+            self.stop_event = threading.Event()
+            self.prefetch_thread = threading.Thread(target=self.prefetch_frames, daemon=True)
+            self.prefetch_thread.start()
+
+        with self.prefetch_condition:
+            self.requested_frame_num = frame_num
+            self.prefetch_pending = True
+            self.prefetch_condition.notify()
+
+    def get_prefetch_order(self, frame_num):
+        # The requested frame and the frames after it come first, as they can be read sequentially,
+        # then the frames behind it, from the furthest back so they only need one seek
+        frames_ahead = range(frame_num, min(frame_num + self.prefetch_ahead + 1, self.num_frames))
+        frames_behind = range(max(frame_num - self.prefetch_behind, 0), frame_num)
+        return list(frames_ahead) + list(frames_behind)
+
+    def prefetch_frames(self):
+        while True:
+            with self.prefetch_condition:
+                self.prefetch_condition.wait_for(lambda: self.prefetch_pending or self.stop_event.is_set())
+                if self.stop_event.is_set():
+                    return
+                self.prefetch_pending = False
+                frame_num = self.requested_frame_num
+
+            for prefetch_frame_num in self.get_prefetch_order(frame_num):
+                # Give up on this position as soon as a newer one is requested
+                if self.prefetch_pending or self.stop_event.is_set():
+                    break
+                if prefetch_frame_num in self.frame_cache:
+                    continue
+                try:
+                    self.decode_frame(prefetch_frame_num)
+                except ValueError:
+                    break
+
+    def release(self):
+        # Stops prefetching, closes the decoder and drops the cached frames. Asking for another frame opens it all again
+        if self.prefetch_thread is not None:
+            with self.prefetch_condition:
+                self.stop_event.set()
+                self.prefetch_condition.notify()
+            self.prefetch_thread.join()
+            self.prefetch_thread = None
+
+        with self.capture_lock:
+            if self.video is not None:
+                self.video.release()
+                self.video = None
+        self.frame_cache.clear()
+
+    def is_open(self):
+        return self.video is not None
+
+
+class VideoLoaderRegistry:
+    # Hands out one VideoLoader per video, so every tab showing a camera shares its decoder, frame cache and prefetch thread
+    def __init__(self):
+        self.video_loaders = {}
+        self.lock = threading.Lock()
+
+    def get_video_loader(self, video_path):
+        video_path = Path(video_path)
+        with self.lock:
+            video_loader = self.video_loaders.get(video_path)
+            if video_loader is None:
+                video_loader = VideoLoader(video_path)
+                self.video_loaders[video_path] = video_loader
+            return video_loader
+
+    def release_all(self):
+        for video_loader in list(self.video_loaders.values()):
+            video_loader.release()
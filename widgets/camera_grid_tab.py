@@ -0,0 +1,161 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg
+from matplotlib.figure import Figure
+from PyQt6.QtCore import Qt
+from PyQt6.QtWidgets import QSlider, QVBoxLayout, QWidget
+
+from utils.video_loader import VideoLoaderRegistry
+
+
+class CameraGridTab(QWidget):
+    # Shows every camera at the same frame. The cameras' decoders decode the frame at once in a thread pool,
+    # they come from a registry so they're shared with the camera's own tab
+    def __init__(self, video_paths, joint_data_loader, number_of_frames, video_loader_registry=None, proxy_paths=None):
+        super().__init__()
+        self.video_paths = list(video_paths)
+        self.joint_data_loader = joint_data_loader
+        self.video_loader_registry = video_loader_registry if video_loader_registry is not None else VideoLoaderRegistry()
+        self.video_loaders = [self.video_loader_registry.get_video_loader(video_path) for video_path in self.video_paths]
+        self.joint_scales = np.ones((len(self.video_paths), 1, 2))  # each camera's shown frame size relative to its full video, as XY
+        self.decoding_executor = None  # started with the first frame and shut down with the decoders
+        # Proxies that are already made are swapped in before anything is decoded, so the full videos are never opened for the grid
+        for camera_num, video_path in enumerate(self.video_paths):
+            if proxy_paths is not None and video_path in proxy_paths:
+                self.use_proxy_video(camera_num, proxy_paths[video_path])
+
+        self.layout = QVBoxLayout()
+        self.setLayout(self.layout)
+
+        self.slider = QSlider(Qt.Orientation.Horizontal)
+        self.slider.setRange(0, number_of_frames - 1)
+        self.slider.valueChanged.connect(self.update_frame)
+        self.layout.addWidget(self.slider)
+
+        self.fig = Figure()
+        self.canvas = FigureCanvasQTAgg(self.fig)
+        self.layout.addWidget(self.canvas)
+
+        # The axes and artists are made once, like in VideoTab, and each frame is blitted over the saved background
+        number_of_rows = max(int(np.floor(np.sqrt(len(self.video_paths)))), 1)
+        number_of_columns = int(np.ceil(len(self.video_paths) / number_of_rows))
+        self.axes = []
+        for camera_num, video_path in enumerate(self.video_paths):
+            ax = self.fig.add_subplot(number_of_rows, number_of_columns, camera_num + 1)
+            ax.axis('off')
+            ax.set_title(video_path.name, fontsize=8)
+            self.axes.append(ax)
+        self.fig.subplots_adjust(left=0, right=1, bottom=0, top=0.95, wspace=0.02, hspace=0.1)
+        self.image_artists = [None] * len(self.video_paths)
+        self.joint_scatters = [None] * len(self.video_paths)
+        self.background = None
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+        # The first frame is drawn when the tab is shown
+
+    def set_proxy_videos(self, proxy_paths, video_loaders_in_use=()):
+        # The full videos' loaders are released once the proxies replace them, unless a camera's own tab is using them
+        for camera_num, video_path in enumerate(self.video_paths):
+            if video_path not in proxy_paths:
+                continue
+            replaced_video_loader = self.use_proxy_video(camera_num, proxy_paths[video_path])
+            if replaced_video_loader is not None and replaced_video_loader not in video_loaders_in_use:
+                replaced_video_loader.release()
+
+        if self.isVisible():
+            self.update_frame(self.slider.value())
+
+    def use_proxy_video(self, camera_num, proxy_path):
+        # The grid cells are small, so the proxies are used for every frame instead of only while scrubbing.
+        # Returns the loader the proxy replaced, or None if the proxy doesn't match the video
+        video_loader = self.video_loaders[camera_num]
+        proxy_video_loader = self.video_loader_registry.get_video_loader(proxy_path)
+        if proxy_video_loader is video_loader or proxy_video_loader.num_frames != video_loader.num_frames:
+            return None
+
+        self.joint_scales[camera_num] = [
+            proxy_video_loader.frame_width / video_loader.frame_width,
+            proxy_video_loader.frame_height / video_loader.frame_height,
+        ]
+        self.video_loaders[camera_num] = proxy_video_loader
+        return video_loader
+
+    def set_number_of_frames(self, number_of_frames):
+        self.slider.setRange(0, number_of_frames - 1)
+
+    def get_video_loaders(self):
+        return list(self.video_loaders)
+
+    def release_decoders(self, video_loaders_in_use=()):
+        # The decoders and the thread pool start again on their own when the grid next shows a frame. Loaders another tab is showing are left open
+        for video_loader in self.video_loaders:
+            if video_loader not in video_loaders_in_use:
+                video_loader.release()
+        if self.decoding_executor is not None:
+            self.decoding_executor.shutdown()
+            self.decoding_executor = None
+
+    def set_shared_frame(self, frame_num):
+        if self.slider.value() == frame_num:
+            return
+        self.slider.blockSignals(True)
+        self.slider.setValue(frame_num)
+        self.slider.blockSignals(False)
+        if self.isVisible():
+            self.update_frame(frame_num)
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.update_frame(self.slider.value())
+
+    def update_frame(self, value):
+        # Decode every camera's frame in parallel and only draw once they're all ready
+        if self.decoding_executor is None:
+            self.decoding_executor = ThreadPoolExecutor(max_workers=max(len(self.video_paths), 1))
+        frames = list(self.decoding_executor.map(lambda video_loader: video_loader.get_frame(value), self.video_loaders))
+        joints = self.joint_data_loader.get_joints_for_all_cameras(value) * self.joint_scales
+
+        needs_full_draw = False
+        for camera_num, frame in enumerate(frames):
+            image_artist = self.image_artists[camera_num]
+            if image_artist is None or image_artist.get_array().shape != frame.shape:
+                self.set_image_size(camera_num, frame)
+                needs_full_draw = True
+            else:
+                image_artist.set_data(frame)
+
+            camera_joints = joints[camera_num]
+            self.joint_scatters[camera_num].set_offsets(camera_joints[~np.isnan(camera_joints).any(axis=1)])
+
+        if needs_full_draw or self.background is None:
+            self.canvas.draw()
+        else:
+            self.blit()
+
+    def set_image_size(self, camera_num, frame):
+        height, width, _ = frame.shape
+        ax = self.axes[camera_num]
+        if self.image_artists[camera_num] is None:
+            self.image_artists[camera_num] = ax.imshow(frame, animated=True)
+            self.joint_scatters[camera_num] = ax.scatter([], [], color='white', s=2, animated=True)
+        else:
+            self.image_artists[camera_num].set_data(frame)
+        self.image_artists[camera_num].set_extent((-0.5, width - 0.5, height - 0.5, -0.5))
+
+        ax.set_xlim([0, width])
+        ax.set_ylim([height, 0])  # the y-axis is inverted in image coordinates
+
+    def on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self.draw_artists()
+
+    def draw_artists(self):
+        for ax, image_artist, joint_scatter in zip(self.axes, self.image_artists, self.joint_scatters):
+            if image_artist is not None:
+                ax.draw_artist(image_artist)
+                ax.draw_artist(joint_scatter)
+
+    def blit(self):
+        self.canvas.restore_region(self.background)
+        self.draw_artists()
+        self.canvas.blit(self.fig.bbox)
@@ -0,0 +1,15 @@
+from PyQt6.QtCore import QThread, pyqtSignal
+
+from utils.video_loader import FrameIndex
+
+
+class FrameIndexThread(QThread):
+    frame_indexes_ready = pyqtSignal(object)  # [FrameIndex, ...] in the order of video_paths
+
+    def __init__(self, video_paths, parent=None):
+        super().__init__(parent)
+        self.video_paths = list(video_paths)
+
+    def run(self):
+        # Only the first time a video is opened does this read through it, after that the saved index is loaded
+        self.frame_indexes_ready.emit([FrameIndex.load_or_build(video_path) for video_path in self.video_paths])
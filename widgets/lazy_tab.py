@@ -0,0 +1,26 @@
+import time
+
+from PyQt6.QtWidgets import QVBoxLayout, QWidget
+
+
+class LazyTab(QWidget):
+    # A placeholder tab that only builds its real widget the first time it's shown
+    def __init__(self, create_widget, parent=None):
+        super().__init__(parent)
+        self.create_widget = create_widget
+        self.widget = None
+        self.last_active_time = time.monotonic()
+
+        self.layout = QVBoxLayout()
+        self.layout.setContentsMargins(0, 0, 0, 0)
+        self.setLayout(self.layout)
+
+    def get_widget(self):
+        if self.widget is None:
+            self.widget = self.create_widget()
+            self.layout.addWidget(self.widget)
+        return self.widget
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.get_widget()
@@ -1,24 +1,57 @@
-from PyQt6.QtWidgets import QApplication, QMainWindow, QTabWidget, QVBoxLayout, QHBoxLayout, QSlider, QWidget, QCheckBox, QPushButton, QGroupBox, QLabel, QLineEdit
+from PyQt6.QtWidgets import QApplication, QMainWindow, QTabWidget, QVBoxLayout, QHBoxLayout, QSlider, QWidget, QCheckBox, QPushButton, QGroupBox, QLabel, QLineEdit, QProgressBar
 from PyQt6.QtCore import Qt
+from PyQt6.QtGui import QOpenGLContext, QOffscreenSurface
 from pathlib import Path
 import numpy as np
 from matplotlib.figure import Figure
 from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg
+from mpl_toolkits.mplot3d.art3d import Line3DCollection
+
+from utils.mediapipe_joints import get_skeleton_connections
+from widgets.reconstruction_thread import ReconstructionThread
+
+# pyqtgraph's OpenGL widgets are optional, the 3D view falls back to matplotlib without them
+try:
+    import pyqtgraph as pg
+    import pyqtgraph.opengl as gl
+except ImportError:
+    pg = None
+    gl = None
+
+def can_create_opengl_context():
+    # pyqtgraph importing doesn't mean OpenGL works here (offscreen, over remote desktop or without a GL driver), so try making a context.
+    # Checked once, the answer doesn't change while the app runs
+    global opengl_context_available
+    if opengl_context_available is None:
+        context = QOpenGLContext()
+        surface = QOffscreenSurface()
+        surface.create()
+        opengl_context_available = context.create() and surface.isValid() and context.makeCurrent(surface)
+        if opengl_context_available:
+            context.doneCurrent()
+    return opengl_context_available
+
+
+opengl_context_available = None
+
 
 class ScatterPlot3DWidget(QWidget):
+    # Shows a frame of the reconstruction as joints and skeleton bones. The artists are made once and each frame only swaps their vertices,
+    # drawn with OpenGL through pyqtgraph when it is installed and an OpenGL context can be made, and with matplotlib otherwise
     def __init__(self, data_holder, parent=None):
         super(ScatterPlot3DWidget, self).__init__(parent)
         self.data_holder = data_holder
+        self.bone_joint_nums = np.array(get_skeleton_connections())
 
         # Layout
         self.layout = QVBoxLayout()
         self.setLayout(self.layout)
 
         # 3D Scatter Plot
-        self.figure = Figure(figsize=(5, 5), dpi=100)
-        self.canvas = FigureCanvasQTAgg(self.figure)
-        self.ax = self.figure.add_subplot(111, projection='3d')
-        self.layout.addWidget(self.canvas)
+        if gl is not None and can_create_opengl_context():
+            self.create_opengl_view()
+        else:
+            self.create_matplotlib_view()
 
         # Slider Layout
         self.slider_layout = QHBoxLayout()
@@ -42,6 +75,25 @@ class ScatterPlot3DWidget(QWidget):
         self.mean_y = 0
         self.mean_z = 0
 
+    def create_opengl_view(self):
+        self.gl_view = gl.GLViewWidget()
+        self.joint_scatter = gl.GLScatterPlotItem(pos=np.zeros((0, 3)), size=6, color=(0.2, 0.6, 1.0, 1.0))
+        self.bone_lines = gl.GLLinePlotItem(pos=np.zeros((0, 3)), mode='lines', width=2, color=(0.8, 0.8, 0.8, 1.0))
+        self.gl_view.addItem(self.bone_lines)
+        self.gl_view.addItem(self.joint_scatter)
+        self.layout.addWidget(self.gl_view)
+
+    def create_matplotlib_view(self):
+        self.gl_view = None
+        self.figure = Figure(figsize=(5, 5), dpi=100)
+        self.canvas = FigureCanvasQTAgg(self.figure)
+        self.ax = self.figure.add_subplot(111, projection='3d')
+        self.joint_scatter = self.ax.scatter([], [], [])
+        # Starts with a placeholder bone, as some matplotlib versions can't add an empty 3D collection
+        self.bone_lines = Line3DCollection([np.zeros((2, 3))], colors='gray')
+        self.ax.add_collection3d(self.bone_lines)
+        self.layout.addWidget(self.canvas)
+
     def set_reconstructed_data(self, data):
         self.slider.setEnabled(True)
         self.slider.setMaximum(len(data) - 1)
@@ -50,26 +102,37 @@ class ScatterPlot3DWidget(QWidget):
         self.mean_y = np.nanmean(data[:, 0:33, 1])
         self.mean_z = np.nanmean(data[:, 0:33, 2])
 
-    def update_plot(self, value):
-        # Clear the current plot
-        self.ax.cla()
+        # The view is only framed when new data comes in, not on every frame
+        if self.gl_view is not None:
+            self.gl_view.setCameraPosition(pos=pg.Vector(self.mean_x, self.mean_y, self.mean_z), distance=3 * self.ax_range)
+        else:
+            # Set equal axes based on mean for entire reconstructed data
+            self.ax.set_xlim([self.mean_x - self.ax_range, self.mean_x + self.ax_range])
+            self.ax.set_ylim([self.mean_y - self.ax_range, self.mean_y + self.ax_range])
+            self.ax.set_zlim([self.mean_z - self.ax_range, self.mean_z + self.ax_range])
+
+        # Redraw with the new data
+        self.update_plot(self.slider.value())
 
+    def update_plot(self, value):
         # Update frame label
         self.frame_label.setText(f"Frame {value}")
 
-        # Get the data for the selected frame
+        # Get the data for the selected frame, leaving out joints and bones that weren't reconstructed
         frame_data = self.data_holder.new_3d_data[value, 0:33, :]
+        joints = frame_data[~np.isnan(frame_data).any(axis=1)]
+        bones = frame_data[self.bone_joint_nums]  # [numBones, 2, XYZ]
+        bones = bones[~np.isnan(bones).any(axis=(1, 2))]
 
-        # Update the scatter plot with the new data
-        self.ax.scatter(frame_data[:, 0], frame_data[:, 1], frame_data[:, 2])
-
-        # Set equal axes based on mean for entire reconstructed data
-        self.ax.set_xlim([self.mean_x - self.ax_range, self.mean_x + self.ax_range])
-        self.ax.set_ylim([self.mean_y - self.ax_range, self.mean_y + self.ax_range])
-        self.ax.set_zlim([self.mean_z - self.ax_range, self.mean_z + self.ax_range])
-
-        # Redraw the plot
-        self.canvas.draw()
+        # Swap the new vertices into the existing artists
+        if self.gl_view is not None:
+            self.joint_scatter.setData(pos=joints)
+            self.bone_lines.setData(pos=bones.reshape(-1, 3))
+        else:
+            self.joint_scatter.set_offsets(joints[:, :2])
+            self.joint_scatter.set_3d_properties(joints[:, 2], 'z')
+            self.bone_lines.set_segments(bones)
+            self.canvas.draw_idle()
 
 
 class MainTab(QWidget):
@@ -93,6 +156,9 @@ class MainTab(QWidget):
         self.save_button = QPushButton("Save Data")
         self.save_button.clicked.connect(self.save_data)
         self.layout.addWidget(self.save_button)
+
+        self.save_status_label = QLabel("")
+        self.layout.addWidget(self.save_status_label)
         
         # Horizontal layout for start and end frame input
         self.frame_range_layout = QHBoxLayout()
@@ -114,21 +180,84 @@ class MainTab(QWidget):
         # Add horizontal layout to the main layout
         self.layout.addLayout(self.frame_range_layout)
 
+        # Horizontal layout for the reconstruct button, its progress and cancelling it
+        self.reconstruction_layout = QHBoxLayout()
+
         self.reconstruction_button = QPushButton("Reconstruct")
         self.reconstruction_button.clicked.connect(self.reconstruct_3d_data)
-        self.layout.addWidget(self.reconstruction_button)
+        self.reconstruction_layout.addWidget(self.reconstruction_button)
+
+        self.reconstruction_progress_bar = QProgressBar()
+        self.reconstruction_progress_bar.setValue(0)
+        self.reconstruction_layout.addWidget(self.reconstruction_progress_bar)
+
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.setEnabled(False)
+        self.cancel_button.clicked.connect(self.cancel_reconstruction)
+        self.reconstruction_layout.addWidget(self.cancel_button)
+
+        self.layout.addLayout(self.reconstruction_layout)
+
+        self.reconstruction_status_label = QLabel("")
+        self.layout.addWidget(self.reconstruction_status_label)
+
+        self.reconstruction_thread = None
 
     def save_data(self):
         path = Path(self.path_input.text())
-        np.save(path / 'mediapipe2dData_numCams_numFrames_numTrackedPoints_pixelXY.npy', self.joint_data_holder.joint_data)
+        try:
+            self.joint_data_holder.save_joint_data(path / 'mediapipe2dData_numCams_numFrames_numTrackedPoints_pixelXY.npy')
+        except ValueError as e:
+            self.save_status_label.setText(str(e))
+            return
+        # The reconstruction is only saved once there is one
+        if self.reconstructed_data_holder.new_3d_data is not None:
+            self.reconstructed_data_holder.save_reconstruction(path / 'reconstruction_store')
+        self.save_status_label.setText(f"Saved to {path}")
 
     def reconstruct_3d_data(self):
         # Get the start and end frame numbers from the input fields
         start_frame = int(self.start_frame_input.text())
         end_frame = int(self.end_frame_input.text())
 
-        # Call the reconstruction method with the start and end frames as parameters
-        self.reconstructed_data_holder.reconstruct_new_3d_data(start_frame=start_frame, end_frame=end_frame)
+        # Run the reconstruction on a worker thread so the window stays responsive
+        self.reconstruction_thread = ReconstructionThread(self.reconstructed_data_holder, start_frame, end_frame)
+        self.reconstruction_thread.progress.connect(self.update_reconstruction_progress)
+        self.reconstruction_thread.reconstruction_finished.connect(self.on_reconstruction_finished)
+        self.reconstruction_thread.reconstruction_failed.connect(self.on_reconstruction_failed)
+
+        self.reconstruction_button.setEnabled(False)
+        self.cancel_button.setEnabled(True)
+        self.reconstruction_progress_bar.setValue(0)
+        self.reconstruction_status_label.setText("Reconstructing...")
+
+        self.reconstruction_thread.start()
+
+    def cancel_reconstruction(self):
+        if self.reconstruction_thread is not None and self.reconstruction_thread.isRunning():
+            self.reconstruction_thread.cancel()
+            self.cancel_button.setEnabled(False)
+            self.reconstruction_status_label.setText("Cancelling...")
+
+    def update_reconstruction_progress(self, number_of_points_done, number_of_points):
+        self.reconstruction_progress_bar.setMaximum(number_of_points)
+        self.reconstruction_progress_bar.setValue(number_of_points_done)
 
+    def on_reconstruction_finished(self, completed):
+        self.reset_reconstruction_controls()
+
+        if not completed:
+            self.reconstruction_status_label.setText("Reconstruction cancelled")
+            return
+
+        self.reconstruction_status_label.setText("Reconstruction finished")
         self.scatter_plot_widget.set_reconstructed_data(self.reconstructed_data_holder.new_3d_data)
 
+    def on_reconstruction_failed(self, error_message):
+        self.reset_reconstruction_controls()
+        self.reconstruction_status_label.setText(f"Reconstruction failed: {error_message}")
+
+    def reset_reconstruction_controls(self):
+        self.reconstruction_button.setEnabled(True)
+        self.cancel_button.setEnabled(False)
+
@@ -0,0 +1,105 @@
+import time
+
+from PyQt6.QtCore import QObject, QTimer, Qt, pyqtSignal
+
+
+class PlaybackController(QObject):
+    # Holds the frame index shared by every camera tab and plays it back in real time.
+    # The frame to show is worked out from the time since playback started, so frames that can't be shown in time are dropped
+    frame_changed = pyqtSignal(int)
+    playback_state_changed = pyqtSignal(bool)  # True when playback starts, False when it stops
+
+    def __init__(self, number_of_frames, fps=30, parent=None):
+        super().__init__(parent)
+        self.number_of_frames = number_of_frames
+        self.fps = fps
+        self.current_frame = 0
+
+        self.timer = QTimer(self)
+        self.timer.setTimerType(Qt.TimerType.PreciseTimer)
+        self.timer.timeout.connect(self.advance)
+        self.playback_start_time = None
+        self.playback_start_frame = 0
+
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.frames_shown = 0
+        self.dropped_frames = 0
+        self.last_latency = 0.0  # seconds from a timer tick to its frame having been shown
+        self.total_latency = 0.0
+
+    def get_mean_latency(self):
+        return self.total_latency / self.frames_shown if self.frames_shown else 0.0
+
+    def is_playing(self):
+        return self.timer.isActive()
+
+    def set_timing(self, number_of_frames, fps):
+        # For when the videos' frame counts and frame rate are only known after playback was set up
+        self.number_of_frames = number_of_frames
+        self.fps = fps
+        if self.is_playing():
+            self.restart_clock()
+            self.timer.start(max(1, int(1000 / self.fps / 2)))
+        if self.current_frame > number_of_frames - 1:
+            self.set_frame(number_of_frames - 1)
+
+    def set_frame(self, frame_num):
+        frame_num = min(max(frame_num, 0), self.number_of_frames - 1)
+        if frame_num == self.current_frame:
+            return
+        self.current_frame = frame_num
+
+        # A jump during playback carries on playing from the new frame
+        if self.is_playing():
+            self.restart_clock()
+        self.frame_changed.emit(frame_num)
+
+    def play(self):
+        if self.is_playing():
+            return
+        if self.current_frame >= self.number_of_frames - 1:
+            self.set_frame(0)
+
+        self.reset_counters()
+        self.restart_clock()
+        # Ticking at twice the frame rate keeps each frame within half a frame of when it's due
+        self.timer.start(max(1, int(1000 / self.fps / 2)))
+        self.playback_state_changed.emit(True)
+
+    def pause(self):
+        if not self.is_playing():
+            return
+        self.timer.stop()
+        self.playback_state_changed.emit(False)
+
+    def toggle_playback(self):
+        if self.is_playing():
+            self.pause()
+        else:
+            self.play()
+
+    def restart_clock(self):
+        self.playback_start_time = time.perf_counter()
+        self.playback_start_frame = self.current_frame
+
+    def advance(self):
+        tick_time = time.perf_counter()
+        target_frame = self.playback_start_frame + int((tick_time - self.playback_start_time) * self.fps)
+        target_frame = min(target_frame, self.number_of_frames - 1)
+        if target_frame <= self.current_frame:
+            return
+
+        # Every frame between the last one shown and this one was skipped to keep up
+        self.dropped_frames += target_frame - self.current_frame - 1
+        self.current_frame = target_frame
+        self.frame_changed.emit(target_frame)
+
+        # The tabs draw the frame as the signal is emitted, so this covers decoding and rendering it
+        self.last_latency = time.perf_counter() - tick_time
+        self.total_latency += self.last_latency
+        self.frames_shown += 1
+
+        if target_frame == self.number_of_frames - 1:
+            self.pause()
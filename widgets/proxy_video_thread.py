@@ -0,0 +1,15 @@
+from PyQt6.QtCore import QThread, pyqtSignal
+
+from utils.proxy_video import create_proxy_videos
+
+
+class ProxyVideoThread(QThread):
+    proxy_videos_ready = pyqtSignal(object)  # {video_path: proxy_path}
+
+    def __init__(self, video_paths, max_height=360, parent=None):
+        super().__init__(parent)
+        self.video_paths = list(video_paths)
+        self.max_height = max_height
+
+    def run(self):
+        self.proxy_videos_ready.emit(create_proxy_videos(self.video_paths, max_height=self.max_height))
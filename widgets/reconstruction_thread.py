@@ -0,0 +1,32 @@
+from PyQt6.QtCore import QThread, pyqtSignal
+import threading
+
+
+class ReconstructionThread(QThread):
+    progress = pyqtSignal(int, int)  # number of points triangulated, total number of points
+    reconstruction_finished = pyqtSignal(bool)  # False if the reconstruction was cancelled
+    reconstruction_failed = pyqtSignal(str)
+
+    def __init__(self, reconstructed_data_holder, start_frame, end_frame, parent=None):
+        super().__init__(parent)
+        self.reconstructed_data_holder = reconstructed_data_holder
+        self.start_frame = start_frame
+        self.end_frame = end_frame
+        self.kill_event = threading.Event()
+
+    def run(self):
+        try:
+            completed = self.reconstructed_data_holder.reconstruct_new_3d_data(
+                start_frame=self.start_frame,
+                end_frame=self.end_frame,
+                kill_event=self.kill_event,
+                progress_callback=self.progress.emit,
+            )
+        except Exception as e:
+            self.reconstruction_failed.emit(str(e))
+            return
+
+        self.reconstruction_finished.emit(completed)
+
+    def cancel(self):
+        self.kill_event.set()
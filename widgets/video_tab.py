@@ -2,35 +2,28 @@
 import cv2
 from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg
 from matplotlib.figure import Figure
-from PyQt6.QtWidgets import QApplication, QMainWindow, QTabWidget, QVBoxLayout, QHBoxLayout, QSlider, QWidget, QCheckBox, QPushButton, QGroupBox, QLabel, QLineEdit
+from PyQt6.QtWidgets import QApplication, QMainWindow, QTabWidget, QVBoxLayout, QHBoxLayout, QSlider, QWidget, QCheckBox, QPushButton, QGroupBox, QLabel, QLineEdit, QComboBox
 from PyQt6.QtCore import Qt
 from pathlib import Path
 
 from utils.mediapipe_joints import mediapipe_indices
+from utils.video_loader import VideoLoaderRegistry
 from widgets.checkbox_list_widget import CheckBoxList
 import numpy as np
+import logging
 
-class VideoLoader:
-    def __init__(self, video_path):
-        self.video = cv2.VideoCapture(str(video_path))
-        self.num_frames = int(self.video.get(cv2.CAP_PROP_FRAME_COUNT))
-
-    def get_frame(self, frame_num):
-        # Seek to the specified frame
-        self.video.set(cv2.CAP_PROP_POS_FRAMES, frame_num)
-
-        # Read the current frame
-        _, frame = self.video.read()
-
-        # Convert the frame from BGR to RGB
-        return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-
+logger = logging.getLogger(__name__)
 
 
 class VideoTab(QWidget):
-    def __init__(self, video_path, joint_data_loader, camera_num):
+    def __init__(self, video_path, joint_data_loader, camera_num, video_loader_registry=None):
         super().__init__()
-        self.video_loader = VideoLoader(video_path)
+        self.video_path = video_path
+        # The loaders come from a registry, so other tabs showing this camera share them
+        self.video_loader_registry = video_loader_registry if video_loader_registry is not None else VideoLoaderRegistry()
+        self.video_loader = self.video_loader_registry.get_video_loader(video_path)
+        self.proxy_video_loader = None  # a low resolution copy shown while the slider is dragged
+        self.proxy_scale = np.ones(2)  # the proxy's size relative to the full video, as XY
         self.joint_data_loader = joint_data_loader
         self.camera_num = camera_num
 
@@ -40,8 +33,13 @@ class VideoTab(QWidget):
 
         # Create the slider and add it to the main layout
         self.slider = QSlider(Qt.Orientation.Horizontal)
-        self.slider.setRange(0, self.video_loader.num_frames - 1)
+        # The frame index gives the exact frame count, so the slider only covers frames that have both video and joint data
+        number_of_frames = min(self.video_loader.num_frames, self.joint_data_loader.get_number_of_frames())
+        if self.video_loader.num_frames != self.joint_data_loader.get_number_of_frames():
+            logger.warning(f"{video_path} has {self.video_loader.num_frames} frames but the joint data has {self.joint_data_loader.get_number_of_frames()}")
+        self.slider.setRange(0, number_of_frames - 1)
         self.slider.valueChanged.connect(self.update_frame)
+        self.slider.sliderReleased.connect(self.update_frame_at_full_resolution)
         self.layout.addWidget(self.slider)
 
         # Create a secondary layout for the video and joint list
@@ -54,16 +52,65 @@ class VideoTab(QWidget):
 
         self.secondary_layout.addWidget(self.canvas)
 
+        # The axes and their artists are made once, each frame only updates the image and joint data and blits them
+        self.ax = self.fig.add_subplot(111)
+        self.ax.axis('off')  # Hide the axes labels (numbers and tick marks)
+        self.fig.subplots_adjust(left=0, right=1, bottom=0, top=1)
+        self.image_artist = None
+        self.joint_scatter = None
+        self.background = None
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+
         # Add the joint list to the right side of the video
         self.joint_list = CheckBoxList(mediapipe_indices)
         self.secondary_layout.addWidget(self.joint_list)
 
+        # Horizontal layout for updating the joints and undoing or redoing joint edits
+        self.edit_layout = QHBoxLayout()
+
         self.update_button = QPushButton("Update Joints")
         self.update_button.clicked.connect(self.update_joints)
-        self.layout.addWidget(self.update_button)
+        self.edit_layout.addWidget(self.update_button)
+
+        self.undo_button = QPushButton("Undo")
+        self.undo_button.clicked.connect(self.undo_joint_edit)
+        self.edit_layout.addWidget(self.undo_button)
+
+        self.redo_button = QPushButton("Redo")
+        self.redo_button.clicked.connect(self.redo_joint_edit)
+        self.edit_layout.addWidget(self.redo_button)
+
+        self.layout.addLayout(self.edit_layout)
 
-        # Display the first frame
-        self.update_frame(0)
+        # Horizontal layout for excluding a joint over a range of frames, from a marked start frame to the slider's frame
+        self.range_layout = QHBoxLayout()
+
+        self.range_joint_combo_box = QComboBox()
+        self.range_joint_combo_box.addItems(mediapipe_indices)
+        self.range_layout.addWidget(self.range_joint_combo_box)
+
+        self.mark_range_start_button = QPushButton("Mark Range Start")
+        self.mark_range_start_button.clicked.connect(self.mark_range_start)
+        self.range_layout.addWidget(self.mark_range_start_button)
+
+        self.range_label = QLabel("")
+        self.range_layout.addWidget(self.range_label)
+
+        self.exclude_range_button = QPushButton("Exclude Range")
+        self.exclude_range_button.clicked.connect(self.exclude_range)
+        self.range_layout.addWidget(self.exclude_range_button)
+
+        self.reinstate_range_button = QPushButton("Reinstate Range")
+        self.reinstate_range_button.clicked.connect(self.reinstate_range)
+        self.range_layout.addWidget(self.reinstate_range_button)
+
+        self.layout.addLayout(self.range_layout)
+
+        self.range_start_frame = 0
+        self.slider.valueChanged.connect(self.update_range_label)
+
+        # The frame is drawn when the tab is shown, by which time it has been moved to the shared frame
+        self.update_range_label(0)
 
         self.setStyleSheet("""
             QCheckBox {
@@ -79,48 +126,148 @@ class VideoTab(QWidget):
 
         
 
-    def update_frame(self, value):
-        # Get the specified frame
-        frame = self.video_loader.get_frame(value)
-
-        # Get the 2D joint positions for the current frame
-        joints = self.joint_data_loader.get_joints(self.camera_num,value)
-
-        # Clear the previous frame
-        self.fig.clear()
-
-        # Plot the current frame on the figure
-        ax = self.fig.add_subplot(111)
-        ax.imshow(frame)
-
-        # Hide the axes labels (numbers and tick marks)
-        ax.axis('off')
+    def set_proxy_video(self, proxy_path):
+        proxy_video_loader = self.video_loader_registry.get_video_loader(proxy_path)
+        if proxy_video_loader.num_frames != self.video_loader.num_frames:
+            logger.warning(f"Not using the proxy {proxy_path}, it has {proxy_video_loader.num_frames} frames instead of {self.video_loader.num_frames}")
+            return
+
+        self.proxy_video_loader = proxy_video_loader
+        self.proxy_scale = np.array([
+            proxy_video_loader.frame_width / self.video_loader.frame_width,
+            proxy_video_loader.frame_height / self.video_loader.frame_height,
+        ])
+
+    def set_shared_frame(self, frame_num):
+        # Moves the slider to the frame shared by all the tabs, hidden tabs only draw it once they're shown
+        if self.slider.value() == frame_num:
+            return
+        self.slider.blockSignals(True)
+        self.slider.setValue(frame_num)
+        self.slider.blockSignals(False)
+        self.update_range_label(frame_num)
+        if self.isVisible():
+            self.update_frame(frame_num)
+
+    def get_video_loaders(self):
+        return [video_loader for video_loader in [self.video_loader, self.proxy_video_loader] if video_loader is not None]
+
+    def release_decoders(self, video_loaders_in_use=()):
+        # The decoders open again on their own when this tab next shows a frame. Loaders another tab is showing are left open
+        for video_loader in self.get_video_loaders():
+            if video_loader not in video_loaders_in_use:
+                video_loader.release()
+
+    def update_frame_at_full_resolution(self):
+        self.update_frame(self.slider.value())
 
+    def update_frame(self, value):
+        # Get the specified frame, from the proxy while the slider is being dragged and at full resolution once it stops
+        if self.proxy_video_loader is not None and self.slider.isSliderDown():
+            frame = self.proxy_video_loader.get_frame(value)
+            joint_scale = self.proxy_scale
+        else:
+            frame = self.video_loader.get_frame(value)
+            joint_scale = 1
+
+        # Get the 2D joint positions for the current frame, in the frame's pixel coordinates
+        joints = self.joint_data_loader.get_joints(self.camera_num,value) * joint_scale
+
+        # Swap the new frame and joints into the existing artists
+        if self.image_artist is None or self.image_artist.get_array().shape != frame.shape:
+            self.set_image_size(frame)
+        else:
+            self.image_artist.set_data(frame)
+
+        # Plot the valid 2D joints as one set of points
+        self.joint_scatter.set_offsets(joints[~np.isnan(joints).any(axis=1)])
+
+        self.blit()
+
+    def set_image_size(self, frame):
+        # The first frame, or a change between the proxy and the full video, needs the artists and limits set up and a full redraw
         height, width, _ = frame.shape
-        ax.set_xlim([0, width])
-        ax.set_ylim([height, 0])  # the y-axis is inverted in image coordinates
-
+        if self.image_artist is None:
+            self.image_artist = self.ax.imshow(frame, animated=True)
+            self.joint_scatter = self.ax.scatter([], [], color = 'white', s = 4, animated=True)
+        else:
+            self.image_artist.set_data(frame)
+        self.image_artist.set_extent((-0.5, width - 0.5, height - 0.5, -0.5))
 
-        valid_joints = [joint for joint in joints if not np.isnan(joint).any()]
+        self.ax.set_xlim([0, width])
+        self.ax.set_ylim([height, 0])  # the y-axis is inverted in image coordinates
 
-        # Plot the 2D joints on the figure
-        if valid_joints:  # only plot if there are valid joints
-            for joint in valid_joints:
-                ax.scatter(joint[0],joint[1], color = 'white', s = 4)
+        self.canvas.draw()
 
-        # Refresh the canvas
-        self.fig.subplots_adjust(left=0, right=1, bottom=0, top=1)
-        # self.canvas.setFixedSize(width, height)
+    def on_draw(self, event):
+        # Every full redraw (including resizes) saves the empty background that the animated artists get blitted over
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self.draw_artists()
 
+    def draw_artists(self):
+        if self.image_artist is not None:
+            self.ax.draw_artist(self.image_artist)
+            self.ax.draw_artist(self.joint_scatter)
 
-        self.canvas.draw()
+    def blit(self):
+        if self.background is None:
+            self.canvas.draw()
+            return
+        self.canvas.restore_region(self.background)
+        self.draw_artists()
+        self.canvas.blit(self.fig.bbox)
 
     def update_joints(self):
         for joint_name, checkbox in self.joint_list.checkboxes.items():
             joint_num = mediapipe_indices.index(joint_name)
             if checkbox.isChecked():
-                self.joint_data_loader.reinstate_joint(self.camera_num, joint_num)
+                # Only joints removed across every frame are reinstated, so excluded frame ranges are left alone
+                if self.joint_data_loader.is_joint_removed(self.camera_num, joint_num):
+                    self.joint_data_loader.reinstate_joint(self.camera_num, joint_num)
             else:
                 self.joint_data_loader.remove_joint(self.camera_num, joint_num)
         
-        self.update_frame(self.slider.value())
\ No newline at end of file
+        self.update_frame(self.slider.value())
+
+    def mark_range_start(self):
+        self.range_start_frame = self.slider.value()
+        self.update_range_label(self.slider.value())
+
+    def update_range_label(self, value):
+        self.range_label.setText(f"Frames {min(self.range_start_frame, value)}-{max(self.range_start_frame, value)}")
+
+    def get_marked_range(self):
+        # The range covers both the marked frame and the slider's frame, whichever way round they are
+        current_frame = self.slider.value()
+        return min(self.range_start_frame, current_frame), max(self.range_start_frame, current_frame) + 1
+
+    def exclude_range(self):
+        joint_num = mediapipe_indices.index(self.range_joint_combo_box.currentText())
+        self.joint_data_loader.exclude_frame_range(self.camera_num, joint_num, *self.get_marked_range())
+        self.sync_joint_checkboxes()
+
+    def reinstate_range(self):
+        joint_num = mediapipe_indices.index(self.range_joint_combo_box.currentText())
+        self.joint_data_loader.reinstate_frame_range(self.camera_num, joint_num, *self.get_marked_range())
+        self.sync_joint_checkboxes()
+
+    def undo_joint_edit(self):
+        if self.joint_data_loader.undo() is not None:
+            self.sync_joint_checkboxes()
+
+    def redo_joint_edit(self):
+        if self.joint_data_loader.redo() is not None:
+            self.sync_joint_checkboxes()
+
+    def sync_joint_checkboxes(self):
+        # The undo history is shared by every camera, so the checkboxes are set from the data holder rather than assumed
+        for joint_name, checkbox in self.joint_list.checkboxes.items():
+            joint_num = mediapipe_indices.index(joint_name)
+            checkbox.setChecked(not self.joint_data_loader.is_joint_removed(self.camera_num, joint_num))
+
+        self.update_frame(self.slider.value())
+
+    def showEvent(self, event):
+        # Another tab may have undone or redone an edit to this camera while it was hidden
+        super().showEvent(event)
+        self.sync_joint_checkboxes()
\ No newline at end of file